@@ -1,10 +1,21 @@
-import copy
+import asyncio
+import concurrent.futures
+import json
+import math
+import multiprocessing
+import os
 import random
-from collections import defaultdict
+import sys
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import defaultdict, deque
 import numpy as np
 
 # Board
 NUM_COLS = 6
+NUM_SQUARES = NUM_COLS * NUM_COLS
 
 # Unit types
 WHITEDUKE = 1
@@ -72,13 +83,12 @@ DRAGOONDOWN = [(0, -1, MOVE), (0, -2, MOVE), (1, -2, JUMP), (-1, -2, JUMP), (-1,
 # Class to represent game tiles
 # Has a type (number) for tile type
 # Has both a set of up facing and down facing moves
-# As well as an indicator of which way it is currently facing
+# Tiles are shared descriptions of a unit, which way a unit faces is stored on the board
 class Tile:
     def __init__(self, type, upMoves, downMoves):
         self.type = type
         self.upMoves = upMoves
         self.downMoves = downMoves
-        self.isUp = True
 
 
 # Game Tiles to use
@@ -100,15 +110,31 @@ BLACKCHAMPIONTILE = Tile(BLACKCHAMPION, CHAMPIONUP, CHAMPIONDOWN)
 WHITEDRAGOONTILE = Tile(WHITEDRAGOON, DRAGOONUP, DRAGOONDOWN)
 BLACKDRAGOONTILE = Tile(BLACKDRAGOON, DRAGOONUP, DRAGOONDOWN)
 
+# Lookup from unit type to its tile
+TILES = {tile.type: tile for tile in [EMPTYTILE, WHITEDUKETILE, BLACKDUKETILE, WHITEFOOTMANTILE, BLACKFOOTMANTILE,
+                                      WHITEASSASSINTILE, BLACKASSASSINTILE, WHITEBOWMANTILE, BLACKBOWMANTILE,
+                                      WHITECHAMPIONTILE, BLACKCHAMPIONTILE, WHITEDRAGOONTILE, BLACKDRAGOONTILE]}
+
+# Unit types (white side, black is the negative) that start in each player's bag
+BAGUNITS = [WHITEFOOTMAN, WHITEASSASSIN, WHITEBOWMAN, WHITECHAMPION, WHITEDRAGOON]
+FULLBAG = 0
+for unitType in BAGUNITS:
+    FULLBAG |= 1 << unitType
+
+
+# Index of the given row and col in a flat board
+def square(row, col):
+    return row * NUM_COLS + col
+
 
 # USE THIS TO GENERATE ALL LEGAL MOVES FOR A TILE AT THE GIVEN ROW AND COL
 # RETURNS 2 ARRAYS, ONE OF THE DESTINATION ROW AND COLS OF ALL VALID MOVES
 # SECOND ARRAY HAS THE TYPE OF MOVE, NEED THAT FOR MAKING MOVE
 def gen_legal_moves(board, row, col):
-    tile = board.board[row][col]
+    tile = TILES[board.squares[square(row, col)]]
     legal_moves = []
     moveTypes = []
-    if tile.isUp:
+    if board.isUp(square(row, col)):
         validDirs = tile.upMoves
     else:
         validDirs = tile.downMoves
@@ -133,7 +159,7 @@ def gen_legal_moves(board, row, col):
             if y_delta < 0:
                 y_factor = -1
             while x_index < abs(x_delta) or y_index < abs(y_delta):
-                if board.board[row + (y_index * y_factor)][col + (x_index * x_factor)] != EMPTYTILE and (
+                if board.squares[square(row + (y_index * y_factor), col + (x_index * x_factor))] != EMPTY and (
                         x_index != 0 and y_index != 0):
                     validMove = False
                 if x_index != abs(x_delta):
@@ -141,21 +167,21 @@ def gen_legal_moves(board, row, col):
                 if y_index != abs(y_delta):
                     y_index += 1
             if validMove == True:
-                targetType = board.board[row + y_delta][col + x_delta].type
+                targetType = board.squares[square(row + y_delta, col + x_delta)]
                 if targetType == EMPTY or (targetType < EMPTY and tile.type > EMPTY) or (
                         targetType > EMPTY and tile.type < EMPTY):
                     legal_moves.append((row + y_delta, col + x_delta))
                     moveTypes.append(moveType)
         # Check the direct space being jumped to
         if moveType == JUMP:
-            targetType = board.board[row + y_delta][col + x_delta].type
+            targetType = board.squares[square(row + y_delta, col + x_delta)]
             if targetType == EMPTY or (targetType < EMPTY and tile.type > EMPTY) or (
                     targetType > EMPTY and tile.type < EMPTY):
                 legal_moves.append((row + y_delta, col + x_delta))
                 moveTypes.append(moveType)
         # Same as jump but can't strike empty space
         if moveType == STRIKE:
-            targetType = board.board[row + y_delta][col + x_delta].type
+            targetType = board.squares[square(row + y_delta, col + x_delta)]
             if (targetType < EMPTY and tile.type > EMPTY) or (
                     targetType > EMPTY and tile.type < EMPTY):
                 legal_moves.append((row + y_delta, col + x_delta))
@@ -174,7 +200,7 @@ def gen_legal_moves(board, row, col):
                 if (y_pos < 0) or (y_pos >= NUM_COLS):
                     stop = True
                     continue
-                targetType = board.board[y_pos][x_pos].type
+                targetType = board.squares[square(y_pos, x_pos)]
                 if targetType == EMPTY:
                     legal_moves.append((y_pos, x_pos))
                     moveTypes.append(moveType)
@@ -201,7 +227,7 @@ def gen_legal_moves(board, row, col):
                 if (y_pos < 0) or (y_pos >= NUM_COLS):
                     stop = True
                     continue
-                targetType = board.board[y_pos][x_pos].type
+                targetType = board.squares[square(y_pos, x_pos)]
                 if targetType == EMPTY:
                     legal_moves.append((y_pos, x_pos))
                     moveTypes.append(moveType)
@@ -218,24 +244,283 @@ def gen_legal_moves(board, row, col):
     return legal_moves, moveTypes
 
 
+# Bitboard move generation
+# Square sq is bit (1 << sq) of an int, so a set of squares fits in one 64 bit mask
+# Everything that only depends on unit type, facing, colour and square is worked out once here
+# MOVETABLE[unitCode(type, isUp) * NUM_SQUARES + sq] is (displaceMask, strikeMask, slideRays) where
+#   displaceMask has the MOVE/JUMP targets and every square on the JUMPSLIDE rays (which pass over anything
+#   in the way), all legal unless a friendly unit is on them
+#   strikeMask has the STRIKE targets, which are only legal onto an enemy unit
+#   slideRays is a list of SLIDE rays as (rayMask, stops) where stops maps the occupied squares on the ray
+#   to (emptyMask, blockerMask), the empty squares the slide passes and the unit it stops at if any
+FULLMASK = (1 << NUM_SQUARES) - 1
+
+
+# Index into MOVETABLE for a unit type and facing
+def unitCode(unitType, isUp):
+    return (unitType + WHITEDRAGOON) * 2 + (not isUp)
+
+
+# Work out where a slide along the ray (square bits in order from the unit outwards) stops
+# for every possible way the squares on it could be occupied
+def build_slide_ray(ray):
+    rayMask = 0
+    for bit in ray:
+        rayMask |= bit
+    stops = {}
+    for occupied in range(1 << len(ray)):
+        occupiedMask = 0
+        emptyMask = 0
+        blockerMask = 0
+        for index, bit in enumerate(ray):
+            if (occupied >> index) & 1:
+                occupiedMask |= bit
+                if not blockerMask:
+                    blockerMask = bit
+            elif not blockerMask:
+                emptyMask |= bit
+        stops[occupiedMask] = (emptyMask, blockerMask)
+    return rayMask, stops
+
+
+# Build the table entry for a unit at the given row and col, following the same rules as gen_legal_moves
+def build_move_entry(unitType, isUp, row, col):
+    tile = TILES[unitType]
+    if isUp:
+        validDirs = tile.upMoves
+    else:
+        validDirs = tile.downMoves
+    displaceMask = 0
+    strikeMask = 0
+    slideRays = []
+    for x_delta, y_delta, moveType in validDirs:
+        if unitType < 0:
+            y_delta *= -1
+        if (col + x_delta < 0) or (col + x_delta >= NUM_COLS):
+            continue
+        if (row + y_delta < 0) or (row + y_delta >= NUM_COLS):
+            continue
+        if moveType == MOVE or moveType == JUMP:
+            displaceMask |= 1 << square(row + y_delta, col + x_delta)
+        elif moveType == STRIKE:
+            strikeMask |= 1 << square(row + y_delta, col + x_delta)
+        else:
+            ray = []
+            x_pos = col + x_delta
+            y_pos = row + y_delta
+            while 0 <= x_pos < NUM_COLS and 0 <= y_pos < NUM_COLS:
+                ray.append(1 << square(y_pos, x_pos))
+                x_pos += x_delta
+                y_pos += y_delta
+            if moveType == SLIDE:
+                slideRays.append(build_slide_ray(ray))
+            else:
+                for bit in ray:
+                    displaceMask |= bit
+    return displaceMask, strikeMask, slideRays
+
+
+MOVETABLE = [None] * ((WHITEDRAGOON * 2 + 1) * 2 * NUM_SQUARES)
+for unitType in TILES:
+    if unitType == EMPTY:
+        continue
+    for isUp in (True, False):
+        for sq in range(NUM_SQUARES):
+            MOVETABLE[unitCode(unitType, isUp) * NUM_SQUARES + sq] = build_move_entry(unitType, isUp,
+                                                                                     *divmod(sq, NUM_COLS))
+
+
+# Zobrist keys for hashing positions, drawn from a fixed seed so every process hashes the same way
+# ZOBRISTSQUARES is indexed like MOVETABLE and covers what is on each square and which way it faces
+# ZOBRISTPLAYERBAG and ZOBRISTAIBAG are indexed by the whole bag bitmask, ZOBRISTBLACK is XORed in when black plays
+ZOBRISTRNG = random.Random(4100)
+ZOBRISTSQUARES = [ZOBRISTRNG.getrandbits(64) for x in range(len(MOVETABLE))]
+ZOBRISTPLAYERBAG = [ZOBRISTRNG.getrandbits(64) for x in range(FULLBAG + 1)]
+ZOBRISTAIBAG = [ZOBRISTRNG.getrandbits(64) for x in range(FULLBAG + 1)]
+ZOBRISTBLACK = ZOBRISTRNG.getrandbits(64)
+# Told apart from the board they share by MCTSTree.node_key, indexed by the drawn unit type + WHITEDRAGOON
+# with EMPTY for the chance node before the draw
+ZOBRISTDRAWN = [ZOBRISTRNG.getrandbits(64) for x in range(WHITEDRAGOON * 2 + 1)]
+
+
+# Yields the index of every set bit in the mask, lowest first
+def iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+# USE THIS FOR FAST MOVE GENERATION OF EVERY UNIT ON ONE SIDE (1 FOR WHITE, -1 FOR BLACK)
+# RETURNS A LIST OF (FROM SQUARE, DISPLACE MASK, STRIKE MASK) FOR EVERY UNIT OF THAT SIDE WITH A LEGAL MOVE
+# DISPLACE MASK HAS SQUARES THE UNIT CAN MOVE TO, STRIKE MASK HAS SQUARES IT CAN STRIKE FROM WHERE IT IS
+def gen_legal_moves_bb(board, side):
+    if side == 1:
+        friendly = board.whiteMask
+        enemy = board.blackMask
+    else:
+        friendly = board.blackMask
+        enemy = board.whiteMask
+    occupied = friendly | enemy
+    notFriendly = FULLMASK & ~friendly
+    squares = board.squares
+    downMask = board.downMask
+    table = MOVETABLE
+    allMoves = []
+    remaining = friendly
+    while remaining:
+        low = remaining & -remaining
+        remaining ^= low
+        sq = low.bit_length() - 1
+        displaceMask, strikeMask, slideRays = \
+            table[((squares[sq] + WHITEDRAGOON) * 2 + ((downMask >> sq) & 1)) * NUM_SQUARES + sq]
+        targets = displaceMask & notFriendly
+        for rayMask, stops in slideRays:
+            emptyMask, blockerMask = stops[occupied & rayMask]
+            targets |= emptyMask | (blockerMask & enemy)
+        strikes = strikeMask & enemy
+        if targets or strikes:
+            allMoves.append((sq, targets, strikes))
+    return allMoves
+
+
+# Duke square once that duke has been captured (or not placed yet)
+NODUKE = -1
+
+# Set to have make_move and unmake_move check everything the board tracks against a full recount
+CHECK_CONSISTENCY = False
+
+
+# Board is a flat array of 36 unit types, one per square (row * NUM_COLS + col)
+# Which way each unit faces is kept as a bitmask with a bit set for every square facing down
+# so copying a board is just a copy of the squares buffer and a couple of ints
+# whiteMask and blackMask have a bit set for every square holding a unit of that side
+# hash is the Zobrist hash of the squares, kept up to date as units are put and removed, see key()
+# whiteDuke and blackDuke are the squares of the dukes (NODUKE once captured), whiteCount and blackCount
+# are how many units each side has on the board, so none of these need a scan of the squares
 class Board:
     def __init__(self, size):
-        self.board = [[EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE],
-                      [EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE],
-                      [EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE],
-                      [EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE],
-                      [EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE],
-                      [EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE, EMPTYTILE]]
+        self.squares = array('b', bytes(NUM_SQUARES))
+        self.downMask = 0
+        self.whiteMask = 0
+        self.blackMask = 0
+        self.hash = 0
+        self.whiteDuke = NODUKE
+        self.blackDuke = NODUKE
+        self.whiteCount = 0
+        self.blackCount = 0
         self.whiteToPlay = 1
         self.bags = Bags()
 
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
+
+    # Returns a copy of this board that shares nothing with it
+    def clone(self):
+        newState = Board.__new__(Board)
+        newState.squares = self.squares[:]
+        newState.downMask = self.downMask
+        newState.whiteMask = self.whiteMask
+        newState.blackMask = self.blackMask
+        newState.hash = self.hash
+        newState.whiteDuke = self.whiteDuke
+        newState.blackDuke = self.blackDuke
+        newState.whiteCount = self.whiteCount
+        newState.blackCount = self.blackCount
+        newState.whiteToPlay = self.whiteToPlay
+        newState.bags = self.bags.clone()
+        return newState
+
+    # Type of the unit at the given row and col
+    def typeAt(self, row, col):
+        return self.squares[square(row, col)]
+
+    # Whether the unit on the given square is facing up
+    def isUp(self, sq):
+        return not (self.downMask >> sq) & 1
+
+    # Zobrist hash of the whole position: squares, facing, side to play and what is left in both bags
+    def key(self):
+        key = self.hash ^ ZOBRISTPLAYERBAG[self.bags.playerBag] ^ ZOBRISTAIBAG[self.bags.aiBag]
+        if self.whiteToPlay != 1:
+            key ^= ZOBRISTBLACK
+        return key
+
+    # Put a unit on the given square, replacing whatever was there
+    def put(self, sq, unitType, isUp=True):
+        if self.squares[sq] != EMPTY:
+            self.remove(sq)
+        bit = 1 << sq
+        self.squares[sq] = unitType
+        if not isUp:
+            self.downMask |= bit
+        self.hash ^= ZOBRISTSQUARES[((unitType + WHITEDRAGOON) * 2 + (not isUp)) * NUM_SQUARES + sq]
+        if unitType > 0:
+            self.whiteMask |= bit
+            self.whiteCount += 1
+            if unitType == WHITEDUKE:
+                self.whiteDuke = sq
+        else:
+            self.blackMask |= bit
+            self.blackCount += 1
+            if unitType == BLACKDUKE:
+                self.blackDuke = sq
+
+    # Remove whatever unit is on the given square
+    def remove(self, sq):
+        oldType = self.squares[sq]
+        if oldType == EMPTY:
+            return
+        bit = 1 << sq
+        self.hash ^= ZOBRISTSQUARES[((oldType + WHITEDRAGOON) * 2 + ((self.downMask >> sq) & 1)) * NUM_SQUARES + sq]
+        self.squares[sq] = EMPTY
+        self.downMask &= ~bit
+        if oldType > 0:
+            self.whiteMask &= ~bit
+            self.whiteCount -= 1
+            if oldType == WHITEDUKE and self.whiteDuke == sq:
+                self.whiteDuke = NODUKE
+        else:
+            self.blackMask &= ~bit
+            self.blackCount -= 1
+            if oldType == BLACKDUKE and self.blackDuke == sq:
+                self.blackDuke = NODUKE
+
+    # Recompute everything the board keeps up to date incrementally from the squares and assert it all matches
+    # Turned on for every make_move and unmake_move by setting CHECK_CONSISTENCY
+    def check_consistency(self):
+        whiteMask = 0
+        blackMask = 0
+        hash = 0
+        whiteDuke = NODUKE
+        blackDuke = NODUKE
+        for sq in range(NUM_SQUARES):
+            unitType = self.squares[sq]
+            if unitType == EMPTY:
+                assert not (self.downMask >> sq) & 1, "empty square " + str(sq) + " is marked as facing down"
+                continue
+            hash ^= ZOBRISTSQUARES[unitCode(unitType, self.isUp(sq)) * NUM_SQUARES + sq]
+            if unitType > 0:
+                whiteMask |= 1 << sq
+            else:
+                blackMask |= 1 << sq
+            if unitType == WHITEDUKE:
+                whiteDuke = sq
+            elif unitType == BLACKDUKE:
+                blackDuke = sq
+        assert self.whiteMask == whiteMask, "whiteMask is out of date"
+        assert self.blackMask == blackMask, "blackMask is out of date"
+        assert self.hash == hash, "hash is out of date"
+        assert self.whiteDuke == whiteDuke, "white duke position is out of date"
+        assert self.blackDuke == blackDuke, "black duke position is out of date"
+        assert self.whiteCount == bin(whiteMask).count("1"), "white unit count is out of date"
+        assert self.blackCount == bin(blackMask).count("1"), "black unit count is out of date"
+
     def print_board(self):
         for row in range(NUM_COLS):
             line = ""
             for col in range(NUM_COLS):
-                line += printable[self.board[row][col].type]
+                line += printable[self.typeAt(row, col)]
             print(line)
         print("\n")
 
@@ -247,177 +532,1248 @@ def showPotentialMoves(board, moves):
             if (row, col) in moves:
                 line += "[" + str(moves.index((row, col))) + "]"
             else:
-                line += printable[board.board[row][col].type]
+                line += printable[board.typeAt(row, col)]
         print(line)
     print("\n")
 
 
 # Will move the unit to the move position based on the assumption it is a legal move and return the new board
 def moveUnit(board, move, moveType, row, col):
-    newState = copy.deepcopy(board)
-    toMove = newState.board[row][col]
-    if moveType != STRIKE:
-        newState.board[move[0]][move[1]] = toMove
-        newState.board[row][col] = EMPTYTILE
-    elif moveType == STRIKE:
-        newState.board[move[0]][move[1]] = EMPTYTILE
-    toMove.isUp = not toMove.isUp
-    newState.whiteToPlay = -1 * newState.whiteToPlay
+    newState = board.clone()
+    make_move(newState, (square(row, col), square(move[0], move[1]), moveType))
     return newState
 
 # Place the given tile at the given placement on the given board and return a new copy of the board
 def placeUnit(board, placement, Tile):
-    newState = copy.deepcopy(board)
-    newState.board[placement[0]][placement[1]] = Tile
-    newState.whiteToPlay = -1 * newState.whiteToPlay
+    newState = board.clone()
+    make_move(newState, (PLACE, square(placement[0], placement[1]), Tile.type))
     return newState
 
 def placeStartingUnit(board, placement, Tile):
-    newState = copy.deepcopy(board)
-    newState.board[placement[0]][placement[1]] = Tile
+    newState = board.clone()
+    newState.put(square(placement[0], placement[1]), Tile.type)
     return newState
 
+# Actions are small tuples that can be applied to a board in place with make_move and taken back with unmake_move
+# Moving a unit is (from square, to square, move type), only STRIKE changes what the move does
+# Placing a unit is (PLACE, square, unit type), the unit is taken out of the bag of its side if still in it
+PLACE = -1
+# Only used by MCTSTree: (DRAW, 0, EMPTY) draws a unit from the bag and (DRAW, 0, unitType) is that unit coming out
+DRAW = -2
+# Packed DRAW actions come after every other packed action
+DRAWCODE = (NUM_SQUARES + 1) * NUM_SQUARES * (WHITEDRAGOON * 2 + 1)
+
+# Apply the action to the board in place, it is assumed to be legal
+# Returns the undo info to give to unmake_move
+def make_move(board, action):
+    fromSq, toSq, moveType = action
+    if fromSq == PLACE:
+        bags = board.bags
+        if moveType > 0:
+            undo = (action, bags.playerBag)
+            bags.playerBag &= ~(1 << moveType)
+        else:
+            undo = (action, bags.aiBag)
+            bags.aiBag &= ~(1 << -moveType)
+        board.put(toSq, moveType)
+    else:
+        undo = (action, board.squares[toSq], board.isUp(toSq))
+        unitType = board.squares[fromSq]
+        isUp = board.isUp(fromSq)
+        board.remove(fromSq)
+        if moveType != STRIKE:
+            board.put(toSq, unitType, not isUp)
+        else:
+            board.remove(toSq)
+            board.put(fromSq, unitType, not isUp)
+    board.whiteToPlay = -board.whiteToPlay
+    if CHECK_CONSISTENCY:
+        board.check_consistency()
+    return undo
+
+# Take back the action make_move returned the undo info for, leaving the board as it was before it
+def unmake_move(board, undo):
+    fromSq, toSq, moveType = undo[0]
+    board.whiteToPlay = -board.whiteToPlay
+    if fromSq == PLACE:
+        board.remove(toSq)
+        if moveType > 0:
+            board.bags.playerBag = undo[1]
+        else:
+            board.bags.aiBag = undo[1]
+    else:
+        capturedType, capturedIsUp = undo[1], undo[2]
+        if moveType != STRIKE:
+            movedFrom = toSq
+        else:
+            movedFrom = fromSq
+        unitType = board.squares[movedFrom]
+        isUp = board.isUp(movedFrom)
+        board.remove(movedFrom)
+        if capturedType != EMPTY:
+            board.put(toSq, capturedType, capturedIsUp)
+        board.put(fromSq, unitType, not isUp)
+    if CHECK_CONSISTENCY:
+        board.check_consistency()
+
+# Pack an action tuple into one small int, for storing many actions compactly
+def pack_action(action):
+    fromSq, toSq, moveType = action
+    if fromSq == DRAW:
+        return DRAWCODE + moveType + WHITEDRAGOON
+    return ((fromSq + 1) * NUM_SQUARES + toSq) * (WHITEDRAGOON * 2 + 1) + moveType + WHITEDRAGOON
+
+# Action tuple back from what pack_action returned
+def unpack_action(code):
+    if code >= DRAWCODE:
+        return DRAW, 0, code - DRAWCODE - WHITEDRAGOON
+    squares, moveType = divmod(code, WHITEDRAGOON * 2 + 1)
+    fromSq, toSq = divmod(squares, NUM_SQUARES)
+    return fromSq - 1, toSq, moveType - WHITEDRAGOON
+
+# Generates all legal moves and strikes for the side to play as a list of action tuples
+def gen_legal_move_list(board):
+    actions = []
+    for fromSq, targets, strikes in gen_legal_moves_bb(board, board.whiteToPlay):
+        for toSq in iter_bits(targets):
+            actions.append((fromSq, toSq, MOVE))
+        for toSq in iter_bits(strikes):
+            actions.append((fromSq, toSq, STRIKE))
+    return actions
+
+# Generates all legal actions for the side to play as a list of action tuples
+# If the side can place a unit, which unit comes out of the bag is drawn at random but not removed until made
+def gen_legal_action_list(board):
+    actions = gen_legal_move_list(board)
+    unitType = board.bags.peek(board.whiteToPlay)
+    if unitType != EMPTY:
+        for row, col in gen_legal_placements(board):
+            actions.append((PLACE, square(row, col), unitType))
+    return actions
+
+# Every unit type that could come out of the bag of the side to play
+def gen_draws(board):
+    side = board.whiteToPlay
+    bag = board.bags.playerBag if side == 1 else board.bags.aiBag
+    return [unitType * side for unitType in BAGUNITS if bag & (1 << unitType)]
+
+# Legal actions for the side to play as MCTSTree searches them: the moves and strikes, then (DRAW, 0, EMPTY)
+# if it can place a unit, with which unit comes out left to a chance node
+def gen_search_action_list(board):
+    actions = gen_legal_move_list(board)
+    if len(gen_draws(board)) != 0 and len(gen_legal_placements(board)) != 0:
+        actions.append((DRAW, 0, EMPTY))
+    return actions
+
 # Will give a list of valid new unit placements based on whose turn it is and where the duke is
 def gen_legal_placements(board):
     target = (0, 0)
-    for row in range(NUM_COLS):
-        for col in range(NUM_COLS):
-            if board.whiteToPlay == 1:
-                if board.board[row][col].type == WHITEDUKE:
-                    target = (row, col)
-            else:
-                if board.board[row][col].type == BLACKDUKE:
-                    target = (row, col)
+    if board.whiteToPlay == 1:
+        duke = board.whiteDuke
+    else:
+        duke = board.blackDuke
+    if duke != NODUKE:
+        target = divmod(duke, NUM_COLS)
     legal_placements = []
     for x_delta, y_delta in SQUAREPLACEMENT:
         if (target[1] + x_delta < 0) or (target[1] + x_delta >= NUM_COLS):
             continue
         if (target[0] + y_delta < 0) or (target[0] + y_delta >= NUM_COLS):
             continue
-        if board.board[target[0] + y_delta][target[1] + x_delta].type == EMPTY:
+        if board.typeAt(target[0] + y_delta, target[1] + x_delta) == EMPTY:
             legal_placements.append((target[0] + y_delta, target[1] + x_delta))
     return legal_placements
 
 # Represent bags of tiles that can be pulled by player
+# Each bag is a bitmask with bit (1 << unit type) set for every white unit type still in it
 class Bags:
     # Start by filling each bag with the correct number of units
     def __init__(self):
-        self.playerBag = [WHITEFOOTMANTILE, WHITEASSASSINTILE, WHITEBOWMANTILE, WHITECHAMPIONTILE, WHITEDRAGOONTILE]
-        self.aiBag = [BLACKFOOTMANTILE, BLACKASSASSINTILE, BLACKBOWMANTILE, BLACKCHAMPIONTILE, BLACKDRAGOONTILE]
+        self.playerBag = FULLBAG
+        self.aiBag = FULLBAG
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def clone(self):
+        newBags = Bags.__new__(Bags)
+        newBags.playerBag = self.playerBag
+        newBags.aiBag = self.aiBag
+        return newBags
+
+    # Type of a random unit still in the bag of the given side, without removing it
+    # Returns EMPTY if bag is empty
+    def peek(self, isPlayersTurn):
+        if isPlayersTurn == 1:
+            bag = self.playerBag
+        else:
+            bag = self.aiBag
+        if bag == 0:
+            return EMPTY
+        options = [unitType for unitType in BAGUNITS if bag & (1 << unitType)]
+        return options[random.randrange(len(options))] * isPlayersTurn
 
     # Pull a unit from the bag based on which player turn it is (bool)
     # Returns an empty tile if bag is empty
     def pull(self, isPlayersTurn):
         if isPlayersTurn == 1:
-            if len(self.playerBag) == 0:
+            if self.playerBag == 0:
                 #print("Bag is empty! Move a unit instead!")
                 return EMPTYTILE
-            toRemove = self.playerBag[random.randrange(len(self.playerBag))]
-            # print("You drew a " + printable[toRemove.type])
-            self.playerBag.remove(toRemove)
-            return toRemove
+            options = [unitType for unitType in BAGUNITS if self.playerBag & (1 << unitType)]
+            toRemove = options[random.randrange(len(options))]
+            # print("You drew a " + printable[toRemove])
+            self.playerBag &= ~(1 << toRemove)
+            return TILES[toRemove]
         else:
-            if len(self.aiBag) == 0:
+            if self.aiBag == 0:
                 return EMPTYTILE
-            toRemove = self.aiBag[random.randrange(len(self.aiBag))]
-            self.aiBag.remove(toRemove)
-            return toRemove
+            options = [unitType for unitType in BAGUNITS if self.aiBag & (1 << unitType)]
+            toRemove = options[random.randrange(len(options))]
+            self.aiBag &= ~(1 << toRemove)
+            return TILES[-toRemove]
+
+# Static evaluation, for scoring games that rollouts cut off before a duke is taken
+# Worth of each unit type on the board, the duke is not counted since losing it ends the game
+UNITVALUES = {WHITEDUKE: 0, WHITEFOOTMAN: 1, WHITEASSASSIN: 3, WHITEBOWMAN: 3, WHITECHAMPION: 4, WHITEDRAGOON: 4}
+# A unit still in the bag is worth this much, it can only come out next to the duke one at a time
+BAGUNITVALUE = 1
+# Worth of each square the duke can move to
+DUKEMOBILITYVALUE = 0.25
+# Score difference that maps to a result of about 0.76 (tanh(1))
+EVALSCALE = 6.0
+
+# Score the board from white's side between -1 and 1 out of material, duke mobility and units left in the bags
+# A board without one of the dukes is scored as the checkResults value
+def static_eval(board):
+    result = checkResults(board)
+    if result != 0:
+        return result
+    score = 0.0
+    for unitType in board.squares:
+        if unitType > 0:
+            score += UNITVALUES[unitType]
+        elif unitType < 0:
+            score -= UNITVALUES[-unitType]
+    score += BAGUNITVALUE * (bin(board.bags.playerBag).count("1") - bin(board.bags.aiBag).count("1"))
+    for dukeSq, side in [(board.whiteDuke, 1), (board.blackDuke, -1)]:
+        # Neither duke is on the board yet while setting up, there is nothing to move
+        if dukeSq == NODUKE:
+            continue
+        moves, moveTypes = gen_legal_moves(board, dukeSq // NUM_COLS, dukeSq % NUM_COLS)
+        score += side * DUKEMOBILITYVALUE * len(moves)
+    return float(np.tanh(score / EVALSCALE))
+
+# Batch rollouts
+# Plays many random games at once in NumPy, one ply of every unfinished game per step
+# The tables below are MOVETABLE spread out over (unit code, from square, to square), codes for empty squares are all False
+# BATCHDISPLACE is where a unit can move to, as long as no friendly unit is there and every square in BATCHBETWEEN is empty
+# BATCHSTRIKE is where a unit can strike, as long as an enemy unit is there
+NUMCODES = len(MOVETABLE) // NUM_SQUARES
+BATCHDISPLACE = np.zeros((NUMCODES, NUM_SQUARES, NUM_SQUARES), dtype=bool)
+BATCHBETWEEN = np.zeros((NUMCODES, NUM_SQUARES, NUM_SQUARES), dtype=np.uint64)
+BATCHSTRIKE = np.zeros((NUMCODES, NUM_SQUARES, NUM_SQUARES), dtype=bool)
+for code in range(NUMCODES):
+    for sq in range(NUM_SQUARES):
+        if MOVETABLE[code * NUM_SQUARES + sq] is None:
+            continue
+        displaceMask, strikeMask, slideRays = MOVETABLE[code * NUM_SQUARES + sq]
+        for rayMask, stops in slideRays:
+            for to in iter_bits(rayMask):
+                BATCHDISPLACE[code, sq, to] = True
+                BATCHBETWEEN[code, sq, to] = stops[1 << to][0]
+        for to in iter_bits(displaceMask):
+            BATCHDISPLACE[code, sq, to] = True
+            BATCHBETWEEN[code, sq, to] = 0
+        for to in iter_bits(strikeMask):
+            BATCHSTRIKE[code, sq, to] = True
+# BATCHADJACENT[sq] is where a unit can be placed around a duke on sq
+BATCHADJACENT = np.zeros((NUM_SQUARES, NUM_SQUARES), dtype=bool)
+for sq in range(NUM_SQUARES):
+    for x_delta, y_delta in SQUAREPLACEMENT:
+        row, col = divmod(sq, NUM_COLS)
+        if 0 <= row + y_delta < NUM_COLS and 0 <= col + x_delta < NUM_COLS:
+            BATCHADJACENT[sq, square(row + y_delta, col + x_delta)] = True
+SQUAREBITS = np.left_shift(np.uint64(1), np.arange(NUM_SQUARES, dtype=np.uint64))
+BAGBITS = np.left_shift(1, np.array(BAGUNITS))
+# Most units one side can have on the board: the duke, two footmen and everything in the bag
+MAXUNITS = 3 + len(BAGUNITS)
+
+
+# Encode boards for batch_rollout
+# Returns (squares, down, bags, sides): the (K, 6, 6) int8 unit types, a (K, 6, 6) bool that is True for
+# units facing down, (K, 2) playerBag and aiBag bitmasks and the (K,) side to play of each board
+def encode_boards(boards):
+    squares = np.array([np.frombuffer(board.squares, dtype=np.int8) for board in boards], dtype=np.int8)
+    downMasks = np.array([board.downMask for board in boards], dtype=np.uint64)
+    down = (downMasks[:, None] & SQUAREBITS) != 0
+    bags = np.array([(board.bags.playerBag, board.bags.aiBag) for board in boards], dtype=np.uint8)
+    sides = np.array([board.whiteToPlay for board in boards], dtype=np.int8)
+    shape = (len(boards), NUM_COLS, NUM_COLS)
+    return squares.reshape(shape), down.reshape(shape), bags, sides
+
+
+# Legal actions of many games at once, squares and down are (K, 36), bags is (K, 2) and sides is (K,)
+# Returns (legal, units): legal is a (K, 2 * U * 36 + 36) bool over every action of each game and units is the
+# (K, U) squares of each game's own units (padded out with squares that are not). Action a of the first U * 36
+# moves the unit on units[a // 36] to square a % 36, the next U * 36 are strikes laid out the same way
+# and the last 36 are placing a unit from the bag on that square
+def batch_legal_actions(squares, down, bags, sides):
+    games = np.arange(len(squares))
+    own = (squares * sides[:, None]) > 0
+    enemy = (squares * sides[:, None]) < 0
+    occupied = own | enemy
+    occupiedBits = np.bitwise_or.reduce(np.where(occupied, SQUAREBITS, np.uint64(0)), axis=1)
+    numUnits = min(int(own.sum(axis=1).max()), MAXUNITS)
+    units = np.argsort(~own, axis=1, kind="stable")[:, :numUnits]
+    unitValid = own[games[:, None], units]
+    codes = (squares[games[:, None], units].astype(np.intp) + WHITEDRAGOON) * 2 + down[games[:, None], units]
+    displace = BATCHDISPLACE[codes, units] & unitValid[:, :, None] & ~own[:, None, :]
+    displace &= (BATCHBETWEEN[codes, units] & occupiedBits[:, None, None]) == 0
+    strike = BATCHSTRIKE[codes, units] & unitValid[:, :, None] & enemy[:, None, :]
+    # Placements go around the duke if anything is left in the bag
+    bag = np.where(sides == 1, bags[:, 0], bags[:, 1])
+    dukeSq = np.argmax(squares == sides[:, None], axis=1)
+    place = BATCHADJACENT[dukeSq] & ~occupied & (bag != 0)[:, None]
+    legal = np.concatenate([displace.reshape(len(squares), -1), strike.reshape(len(squares), -1), place], axis=1)
+    return legal, units
+
+
+# Random playouts from every board at once, using the same rules and move choice as Node.rollout
+# Returns an int8 array with the checkResults value each game ended in, games still going after maxPlies count as 0
+# With evaluate, the results are floats instead and games still going after maxPlies are scored with static_eval
+def batch_rollout(boards, maxPlies=1000, rng=np.random, evaluate=False):
+    squares, down, bags, sides = encode_boards(boards)
+    squares = squares.reshape(len(boards), NUM_SQUARES)
+    down = down.reshape(len(boards), NUM_SQUARES)
+    results = np.zeros(len(boards), dtype=np.float64 if evaluate else np.int8)
+    active = np.arange(len(boards))
+    for ply in range(maxPlies + 1):
+        whiteAlive = (squares[active] == WHITEDUKE).any(axis=1)
+        blackAlive = (squares[active] == BLACKDUKE).any(axis=1)
+        results[active] = np.where(whiteAlive & ~blackAlive, 1, np.where(blackAlive & ~whiteAlive, -1, 0))
+        active = active[whiteAlive & blackAlive]
+        if len(active) == 0:
+            break
+        if ply == maxPlies:
+            if evaluate:
+                for game in active:
+                    results[game] = static_eval(decode_board(squares[game], down[game], bags[game], sides[game]))
+            break
+        legal, units = batch_legal_actions(squares[active], down[active], bags[active], sides[active])
+        # Pick one legal action uniformly for each game, games with none left stop where they are
+        counts = legal.sum(axis=1)
+        moving = counts > 0
+        active, legal, units, counts = active[moving], legal[moving], units[moving], counts[moving]
+        if len(active) == 0:
+            break
+        pick = (rng.random(len(active)) * counts).astype(np.intp)
+        choice = np.argmax(np.cumsum(legal, axis=1) > pick[:, None], axis=1)
+        numUnits = units.shape[1]
+        moveActions = numUnits * NUM_SQUARES
+        isDisplace = choice < moveActions
+        isStrike = (choice >= moveActions) & (choice < 2 * moveActions)
+        isPlace = choice >= 2 * moveActions
+        to = np.where(isPlace, choice - 2 * moveActions, choice % NUM_SQUARES)
+        frm = units[np.arange(len(active)), (np.minimum(choice // NUM_SQUARES, 2 * numUnits - 1)) % numUnits]
+        side = sides[active]
+        # Displace: move the unit over, flipped
+        g, f, t = active[isDisplace], frm[isDisplace], to[isDisplace]
+        unitTypes = squares[g, f]
+        unitDown = down[g, f]
+        squares[g, f] = EMPTY
+        down[g, f] = False
+        squares[g, t] = unitTypes
+        down[g, t] = ~unitDown
+        # Strike: clear the target and flip the striking unit
+        g, f, t = active[isStrike], frm[isStrike], to[isStrike]
+        squares[g, t] = EMPTY
+        down[g, t] = False
+        down[g, f] = ~down[g, f]
+        # Place: draw a random unit out of the bag of that side
+        g, t, placeSide = active[isPlace], to[isPlace], side[isPlace]
+        if len(g):
+            bagColumn = (placeSide != 1).astype(np.intp)
+            inBag = (bags[g, bagColumn][:, None] & BAGBITS) != 0
+            drawn = np.argmax(np.where(inBag, rng.random(inBag.shape), -1.0), axis=1)
+            squares[g, t] = np.array(BAGUNITS, dtype=np.int8)[drawn] * placeSide
+            down[g, t] = False
+            bags[g, bagColumn] &= ~BAGBITS[drawn].astype(np.uint8)
+        sides[active] = -side
+    return results
+
+
+# Board for one game of batch_rollout's arrays, squares and down are (36,), bags is (2,) and side the side to play
+def decode_board(squares, down, bags, side):
+    board = Board(NUM_COLS)
+    for sq in np.flatnonzero(squares):
+        board.put(int(sq), int(squares[sq]), not down[sq])
+    board.bags.playerBag = int(bags[0])
+    board.bags.aiBag = int(bags[1])
+    board.whiteToPlay = int(side)
+    return board
+
+
+# Leaf evaluators
+# A leaf evaluator has evaluate(boards), taking a list of boards and returning an array with a value for each one
+# between -1 and 1 from white's side. MCTSTree hands it batchSize leaves at a time
+# Feature planes for encode_planes, each one 6 x 6: one per unit type, colour and facing (type, then white before
+# black, then up before down), then one that is all ones when white is to play, then one per bag unit of each
+# side (white's first) that is all ones while that unit is still in the bag
+UNITPLANES = WHITEDRAGOON * 4
+SIDEPLANE = UNITPLANES
+BAGPLANES = SIDEPLANE + 1
+NUMPLANES = BAGPLANES + 2 * len(BAGUNITS)
+
+# Encode boards as a (K, NUMPLANES, 6, 6) float32 array of feature planes
+def encode_planes(boards):
+    squares, down, bags, sides = encode_boards(boards)
+    squares = squares.reshape(len(boards), NUM_SQUARES).astype(np.intp)
+    down = down.reshape(len(boards), NUM_SQUARES)
+    planes = np.zeros((len(boards), NUMPLANES, NUM_SQUARES), dtype=np.float32)
+    games, squareIndex = np.nonzero(squares)
+    unitTypes = squares[games, squareIndex]
+    plane = (np.abs(unitTypes) - 1) * 4 + (unitTypes < 0) * 2 + down[games, squareIndex]
+    planes[games, plane, squareIndex] = 1
+    planes[:, SIDEPLANE] = (sides == 1)[:, None]
+    inBag = (bags[:, :, None] & BAGBITS) != 0
+    planes[:, BAGPLANES:] = inBag.reshape(len(boards), -1)[:, :, None]
+    return planes.reshape(len(boards), NUMPLANES, NUM_COLS, NUM_COLS)
+
+# Scores boards by playing them out at random with batch_rollout, the evaluator MCTSTree uses unless given another
+# With maxPlies, games still going after that many plies are scored with static_eval
+class RolloutEvaluator:
+    def __init__(self, maxPlies=None):
+        self.maxPlies = maxPlies
+
+    def evaluate(self, boards):
+        if self.maxPlies is None:
+            return batch_rollout(boards)
+        return batch_rollout(boards, self.maxPlies, evaluate=True)
+
+# Scores boards with tanh(planes . weights + bias) over encode_planes
+# Without weights, units and bag units are worth what they are in static_eval, only without duke mobility
+class LinearEvaluator:
+    def __init__(self, weights=None, bias=0.0):
+        if weights is None:
+            weights = np.zeros((NUMPLANES, NUM_SQUARES), dtype=np.float32)
+            for unitType, value in UNITVALUES.items():
+                for facing in range(2):
+                    weights[(unitType - 1) * 4 + facing] = value / EVALSCALE
+                    weights[(unitType - 1) * 4 + 2 + facing] = -value / EVALSCALE
+            # Bag planes are all ones, so spread the value over every square
+            weights[BAGPLANES:BAGPLANES + len(BAGUNITS)] = BAGUNITVALUE / EVALSCALE / NUM_SQUARES
+            weights[BAGPLANES + len(BAGUNITS):] = -BAGUNITVALUE / EVALSCALE / NUM_SQUARES
+        self.weights = np.asarray(weights, dtype=np.float32).reshape(-1)
+        self.bias = bias
+
+    def evaluate(self, boards):
+        return np.tanh(encode_planes(boards).reshape(len(boards), -1) @ self.weights + self.bias)
+
+# Scores boards with a small multilayer perceptron over encode_planes: one ReLU hidden layer and a tanh output
+# Starts out with small random weights, train it with fit and keep it with save and load
+class MLPEvaluator:
+    def __init__(self, hidden=32, seed=0):
+        rng = np.random.RandomState(seed)
+        inputs = NUMPLANES * NUM_SQUARES
+        self.w1 = (rng.randn(inputs, hidden) / np.sqrt(inputs)).astype(np.float32)
+        self.b1 = np.zeros(hidden, dtype=np.float32)
+        self.w2 = (rng.randn(hidden) / np.sqrt(hidden)).astype(np.float32)
+        self.b2 = np.float32(0)
+
+    def evaluate(self, boards):
+        return self.forward(encode_planes(boards).reshape(len(boards), -1))[0]
+
+    # Values for a (K, inputs) array of flattened planes, and the hidden layer they came from
+    def forward(self, features):
+        hiddenLayer = np.maximum(features @ self.w1 + self.b1, 0)
+        return np.tanh(hiddenLayer @ self.w2 + self.b2), hiddenLayer
+
+    # Fit the model to the given values of the boards (e.g. results of playouts from them) by full batch
+    # gradient descent on the squared error, returns the mean squared error before the last step
+    def fit(self, boards, values, epochs=200, learningRate=0.05):
+        features = encode_planes(boards).reshape(len(boards), -1)
+        values = np.asarray(values, dtype=np.float32)
+        for epoch in range(epochs):
+            predicted, hiddenLayer = self.forward(features)
+            error = predicted - values
+            # Back through the tanh, then the two layers
+            outputGrad = 2 * error * (1 - predicted ** 2) / len(values)
+            hiddenGrad = np.outer(outputGrad, self.w2) * (hiddenLayer > 0)
+            self.w2 -= learningRate * (hiddenLayer.T @ outputGrad)
+            self.b2 -= learningRate * outputGrad.sum()
+            self.w1 -= learningRate * (features.T @ hiddenGrad)
+            self.b1 -= learningRate * hiddenGrad.sum(axis=0)
+        return float(np.mean(error ** 2))
+
+    def save(self, path):
+        np.savez(path, w1=self.w1, b1=self.b1, w2=self.w2, b2=self.b2)
+
+    @classmethod
+    def load(cls, path):
+        weights = np.load(path)
+        evaluator = cls(hidden=weights["w1"].shape[1])
+        evaluator.w1, evaluator.b1, evaluator.w2 = weights["w1"], weights["b1"], weights["w2"]
+        evaluator.b2 = np.float32(weights["b2"])
+        return evaluator
+
 
 # Followed tutorial from https://int8.io/monte-carlo-tree-search-beginners-guide/ for MCTS approach
+# A position in the search: its board, the action that was made to reach it and its statistics
+# MCTSTree keeps the tree itself in arrays, a Node is what goes in as the root and what comes back as the chosen move
 class Node:
-    def __init__(self, boardState, parent=None):
+    def __init__(self, boardState, parent=None, action=None, drawn=EMPTY):
         self.state = boardState
         self.parent = parent
-        self.children = []
+        self.action = action
+        # Unit drawn from the bag that still has to be placed, the only actions then are placing it
+        self.drawn = drawn
         self.num_visits = 0
         self.results = defaultdict(int)
-        self.untried_states = gen_legal_actions(self.state)
 
-    # Get u value for ucb1
-    def u(self):
-        if self.state.whiteToPlay == 1:
-            wins = self.results[1]
-            loses = self.results[-1]
+    # Perform a rollout from this node state and return its value
+    def rollout(self, maxPlies=None):
+        return rollout(self.state, maxPlies)
+
+# Perform a rollout from the given board and return its value, the board itself is left as it is
+def rollout(board, maxPlies=None):
+    return playout(board, maxPlies)[0]
+
+# Play random actions from a copy of the board until the game ends, returns the result and how many plies it took
+# With maxPlies, a game still going after that many plies is stopped and its result is static_eval of the board
+# The copy is counted in stats if given a SearchStats
+def playout(board, maxPlies=None, stats=None):
+    current_state = board.clone()
+    if stats is not None:
+        stats.boardsCopied += 1
+    plies = 0
+    # Find ending game by picking random moves, played in place on one copy of the board
+    while checkResults(current_state) == 0:
+        if plies == maxPlies:
+            return static_eval(current_state), plies
+        actions = gen_legal_action_list(current_state)
+        if len(actions) != 0:
+            make_move(current_state, actions[np.random.randint(len(actions))])
+            plies += 1
+            # current_state.print_board()
+        else:
+            print("No valid states left somehow")
+            # current_state.print_board()
+            break
+    # current_state.print_board()
+    return checkResults(current_state), plies
+
+# Transposition table key for a node of MCTSTree, the key of its board unless it is part of a draw from the bag
+def node_key(board, drawn, chance):
+    key = board.key()
+    if chance:
+        key ^= ZOBRISTDRAWN[WHITEDRAGOON]
+    elif drawn != EMPTY:
+        key ^= ZOBRISTDRAWN[drawn + WHITEDRAGOON]
+    return key
+
+# Copy of the array with room for at least size entries, doubling so growing one entry at a time stays cheap
+def grow_array(values, size):
+    if size <= len(values):
+        return values
+    bigger = np.zeros(max(size, 2 * len(values)), dtype=values.dtype)
+    bigger[:len(values)] = values
+    return bigger
+
+# Rough memory use of one node with its board and untried actions, for turning a byte budget into nodes
+NODEBYTES = 1100
+# Fraction of maxNodes a tree is pruned back down to once it grows past it
+PRUNETARGET = 0.75
+# How much a leaf waiting in a batch counts as a loss for the side choosing it, so the rest of the batch looks elsewhere
+VIRTUALLOSS = 1
+# Index of the root in MCTSTree's arrays
+ROOT = 0
+# Simulations between checks for being told to stop pondering
+PONDERSIMS = 16
+# Memory play() lets its tree use, pondering for as long as the human thinks would otherwise grow it without bound
+PLAYTREEBYTES = 200 * 1024 * 1024
+
+# Bounded map from Board.key() to the index of the node for that position
+# Once full, the oldest entries are forgotten, their nodes stay in the tree but are no longer shared
+class TranspositionTable:
+    def __init__(self, maxEntries=100000):
+        self.maxEntries = maxEntries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        node = self.entries.get(key)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def put(self, key, node):
+        if key not in self.entries and len(self.entries) >= self.maxEntries:
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = node
+
+
+# Where the time went during one MCTSTree.choose_action, filled in when the tree is built with instrument=True
+# times, calls and maxTimes are the total seconds, number of calls and slowest call for each of PHASES
+# Selection time does not include the expansions done during selection, those count as expand
+# rolloutDepths maps playout length in plies to how many playouts were that long (batched playouts are not counted)
+class SearchStats:
+    PHASES = ["selection", "expand", "rollout", "backprop"]
+
+    def __init__(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.maxTimes = dict.fromkeys(self.PHASES, 0.0)
+        self.boardsCopied = 0
+        self.rolloutDepths = defaultdict(int)
+        self.sims = 0
+        self.treeSize = 0
+        self.maxDepth = 0
+
+    def record(self, phase, seconds):
+        self.times[phase] += seconds
+        self.calls[phase] += 1
+        if seconds > self.maxTimes[phase]:
+            self.maxTimes[phase] = seconds
+
+    def to_dict(self):
+        return {
+            "sims": self.sims,
+            "times": self.times,
+            "calls": self.calls,
+            "mean_times": {phase: self.times[phase] / max(self.calls[phase], 1) for phase in self.PHASES},
+            "max_times": self.maxTimes,
+            "boards_copied": self.boardsCopied,
+            "rollout_depths": {str(depth): count for depth, count in sorted(self.rolloutDepths.items())},
+            "tree_size": self.treeSize,
+            "max_depth": self.maxDepth,
+        }
+
+    # Append the stats to an open file as one line of JSON
+    def write_jsonl(self, file):
+        file.write(json.dumps(self.to_dict()) + "\n")
+
+
+# The tree is stored as a struct of arrays indexed by node, growing as nodes are added:
+#   visits, whiteWins and blackWins are the statistics (wins are floats, cut off rollouts score fractions of one),
+#   sides who is to play and terminal the checkResults value of its board
+#   a node's children are edgeChild[firstEdge:firstEdge + edgeCount], with the packed action of each in edgeAction
+#   every node reserves one edge per legal action when it is added, so its children always sit together
+#   states, untried and actions hold the board, the packed untried actions and the action made to reach each node
+# Placing from the bag is searched as (DRAW, 0, EMPTY) to a chance node, which samples the unit that comes out
+# like pulling from the bag would, into a node for that unit (drawn holds its type) whose actions place it
+# Chance nodes and the nodes for each drawn unit share the board they were drawn from, node_key tells them apart
+# With useTable the tree shares nodes between move orders that reach the same position, making it a DAG
+# so results are backpropogated along the path that was selected rather than through parent links
+# With more than one worker, choose_action searches root parallel: every worker process grows its own tree
+# from the root with its own seed, then the statistics of the root's children are added together
+# With a batchSize over one or an evaluator, leaves are evaluated leaf parallel: that many leaves are selected,
+# each with a virtual loss on its path so the next is likely to be a different one, then the virtual losses are
+# taken back and the leaves are scored together by the evaluator (batch_rollout by default) and backpropogated
+# maxNodes (or maxBytes, turned into nodes with NODEBYTES) bounds the size of the tree, once it grows past that
+# the least visited subtrees are pruned, nodes_evicted counts how many nodes that has removed
+# With rolloutPlies, rollouts stop after that many plies and score the board they reach with static_eval
+# start_pondering keeps searching on a background thread, e.g. while the human thinks, until stop_pondering
+# With instrument, every choose_action leaves a SearchStats for the search in stats (root parallel searches
+# only count the simulations), otherwise stats stays None
+class MCTSTree:
+    def __init__(self, node, useTable=True, maxTableEntries=100000, workers=1, seed=None, batchSize=1,
+                 maxNodes=None, maxBytes=None, instrument=False, rolloutPlies=None, evaluator=None):
+        self.useTable = useTable
+        self.maxTableEntries = maxTableEntries
+        self.maxNodes = maxNodes
+        if maxBytes is not None:
+            self.maxNodes = max(1, maxBytes // NODEBYTES)
+        self.nodes_evicted = 0
+        self.prunes = 0
+        self.workers = workers
+        self.seed = seed
+        self.batchSize = batchSize
+        self.num_sims_done = 0
+        self.instrument = instrument
+        self.stats = None
+        self.rolloutPlies = rolloutPlies
+        self.batched = batchSize > 1 or evaluator is not None
+        self.evaluator = evaluator
+        if evaluator is None:
+            self.evaluator = RolloutEvaluator(rolloutPlies)
+        self.ponderThread = None
+        self.ponderStop = threading.Event()
+        self.ponderSims = 0
+        self.clear(node.state, node.drawn)
+
+    # Throw the whole tree away and start again from a root for the board
+    def clear(self, board, drawn=EMPTY):
+        self.size = 0
+        self.visits = np.zeros(64, dtype=np.int64)
+        self.whiteWins = np.zeros(64, dtype=np.float64)
+        self.blackWins = np.zeros(64, dtype=np.float64)
+        self.sides = np.zeros(64, dtype=np.int8)
+        self.terminal = np.zeros(64, dtype=np.int8)
+        self.drawn = np.zeros(64, dtype=np.int8)
+        self.chance = np.zeros(64, dtype=bool)
+        self.firstEdge = np.zeros(64, dtype=np.int64)
+        self.edgeCount = np.zeros(64, dtype=np.int64)
+        self.numEdges = 0
+        self.edgeChild = np.zeros(1024, dtype=np.int64)
+        self.edgeAction = np.zeros(1024, dtype=np.int64)
+        self.states = []
+        self.untried = []
+        self.actions = []
+        self.table = None
+        if self.useTable:
+            self.table = TranspositionTable(self.maxTableEntries)
+        self.add_node(board, None, drawn)
+
+    # Number of nodes in the tree
+    @property
+    def num_nodes(self):
+        return self.size
+
+    # Node for the root, with its statistics
+    @property
+    def root(self):
+        return self.node(ROOT)
+
+    # Node for the given index, holding its board, action and a copy of its statistics
+    def node(self, index):
+        node = Node(self.states[index], action=self.actions[index], drawn=int(self.drawn[index]))
+        node.num_visits = int(self.visits[index])
+        node.results[1] = float(self.whiteWins[index])
+        node.results[-1] = float(self.blackWins[index])
+        node.results[0] = node.num_visits - node.results[1] - node.results[-1]
+        return node
+
+    # Indices of the children of the given node
+    def children(self, index):
+        first = self.firstEdge[index]
+        return self.edgeChild[first:first + self.edgeCount[index]]
+
+    # Statistics of the children of the given node as a list of (packed action, visits, white wins, black wins)
+    def child_stats(self, index):
+        first = self.firstEdge[index]
+        return [(int(self.edgeAction[edge]), int(self.visits[child]), float(self.whiteWins[child]),
+                 float(self.blackWins[child]))
+                for edge, child in enumerate(self.children(index), first)]
+
+    # Transposition table key of the given node
+    def key(self, index):
+        return node_key(self.states[index], self.drawn[index], self.chance[index])
+
+    # Add a node for the board, reached by action, and return its index
+    # drawn and chance are for the nodes of a draw from the bag, see the notes on the class
+    def add_node(self, board, action, drawn=EMPTY, chance=False):
+        index = self.size
+        self.size += 1
+        if self.size > len(self.visits):
+            self.visits = grow_array(self.visits, self.size)
+            self.whiteWins = grow_array(self.whiteWins, self.size)
+            self.blackWins = grow_array(self.blackWins, self.size)
+            self.sides = grow_array(self.sides, self.size)
+            self.terminal = grow_array(self.terminal, self.size)
+            self.drawn = grow_array(self.drawn, self.size)
+            self.chance = grow_array(self.chance, self.size)
+            self.firstEdge = grow_array(self.firstEdge, self.size)
+            self.edgeCount = grow_array(self.edgeCount, self.size)
+        result = checkResults(board)
+        if result != 0:
+            actions = []
+        elif chance:
+            actions = [(DRAW, 0, unitType) for unitType in gen_draws(board)]
+        elif drawn != EMPTY:
+            actions = [(PLACE, square(row, col), drawn) for row, col in gen_legal_placements(board)]
         else:
-            wins = self.results[-1]
-            loses = self.results[1]
-        return wins - loses
-
-    # Get n value for ucb1
-    def n(self):
-        return self.num_visits
-
-    # Expand this node
-    def expand(self):
-        nextMove = self.untried_states.pop()
-        child = Node(nextMove, parent=self)
-        self.children.append(child)
+            actions = gen_search_action_list(board)
+        untried = array('H', [pack_action(action) for action in actions])
+        self.visits[index] = 0
+        self.whiteWins[index] = 0
+        self.blackWins[index] = 0
+        self.sides[index] = board.whiteToPlay
+        self.terminal[index] = result
+        self.drawn[index] = drawn
+        self.chance[index] = chance
+        self.firstEdge[index] = self.numEdges
+        self.edgeCount[index] = 0
+        self.numEdges += len(untried)
+        self.edgeChild = grow_array(self.edgeChild, self.numEdges)
+        self.edgeAction = grow_array(self.edgeAction, self.numEdges)
+        self.states.append(board)
+        self.untried.append(untried)
+        self.actions.append(action)
+        if self.table is not None:
+            self.table.put(node_key(board, drawn, chance), index)
+        return index
+
+    # Add the child reached by the packed action as the given node's next edge and return its index
+    # With a transposition table, a position already in the tree is shared instead of getting a new node
+    def add_child(self, index, code):
+        action = unpack_action(code)
+        drawn = EMPTY
+        chance = False
+        if action[0] == DRAW:
+            # Nothing changes on the board until the drawn unit is placed
+            nextMove = self.states[index]
+            drawn = action[2]
+            chance = drawn == EMPTY
+        else:
+            nextMove = self.states[index].clone()
+            if self.stats is not None:
+                self.stats.boardsCopied += 1
+            make_move(nextMove, action)
+        child = None
+        if self.table is not None:
+            child = self.table.get(node_key(nextMove, drawn, chance))
+        if child is None:
+            child = self.add_node(nextMove, action, drawn, chance)
+        elif (self.children(index) == child).any():
+            return child
+        edge = self.firstEdge[index] + self.edgeCount[index]
+        self.edgeChild[edge] = child
+        self.edgeAction[edge] = code
+        self.edgeCount[index] += 1
         return child
 
-    # Perform a rollout from this node state and return its value
-    def rollout(self):
-        current_state = self.state
-        # Find ending game by picking random moves
-        while checkResults(current_state) == 0:
-            valid_states = gen_legal_actions(current_state)
-            if len(valid_states) != 0:
-                current_state = valid_states[np.random.randint(len(valid_states))]
-                # current_state.print_board()
+    # Expand the given node by one of its untried actions and return the child's index
+    def expand(self, index):
+        if self.stats is None:
+            return self.add_child(index, self.untried[index].pop())
+        start = time.perf_counter()
+        child = self.add_child(index, self.untried[index].pop())
+        self.stats.record("expand", time.perf_counter() - start)
+        return child
+
+    # Sample the unit that comes out of the bag at the given chance node, adding the node for it if there is none
+    # Returns the index of that node and whether it was just added
+    def draw(self, index):
+        code = pack_action((DRAW, 0, self.states[index].bags.peek(int(self.sides[index]))))
+        first = self.firstEdge[index]
+        edges = np.flatnonzero(self.edgeAction[first:first + self.edgeCount[index]] == code)
+        if len(edges) != 0:
+            return int(self.edgeChild[first + edges[0]]), False
+        self.untried[index].remove(code)
+        return self.add_child(index, code), True
+
+    # Board to roll out from for the given node, a drawn unit waiting to be placed goes on a random square first
+    def leaf_board(self, index):
+        board = self.states[index]
+        if self.drawn[index] != EMPTY:
+            board = board.clone()
+            if self.stats is not None:
+                self.stats.boardsCopied += 1
+            placements = gen_legal_placements(board)
+            row, col = placements[np.random.randint(len(placements))]
+            make_move(board, (PLACE, square(row, col), int(self.drawn[index])))
+        return board
+
+    # Returns the best child to explore next using the UCB1 policy, scored for the side choosing between them
+    def best_child(self, index):
+        children = self.children(index)
+        visits = self.visits[children]
+        # A child still waiting on a batched rollout has no visits yet, go there first
+        unvisited = np.flatnonzero(visits == 0)
+        if len(unvisited) != 0:
+            return int(children[unvisited[0]])
+        if self.sides[index] == 1:
+            u = self.whiteWins[children] - self.blackWins[children]
+        else:
+            u = self.blackWins[children] - self.whiteWins[children]
+        weights = (u / visits) + 1.4 * np.sqrt(2 * np.log(max(self.visits[index], 1)) / visits)
+        return int(children[np.argmax(weights)])
+
+    # Returns the child to play from the given node: the most visited, ties going to the best mean value for the side
+    # choosing. Unlike best_child there is no exploration bonus, that is only for descending the tree
+    def most_visited_child(self, index):
+        children = self.children(index)
+        visits = self.visits[children]
+        if self.sides[index] == 1:
+            u = self.whiteWins[children] - self.blackWins[children]
+        else:
+            u = self.blackWins[children] - self.whiteWins[children]
+        values = u / np.maximum(visits, 1)
+        return int(children[np.lexsort((values, visits))[-1]])
+
+    # Backpropogate a game result between -1 and 1 along the path of node indices
+    def backpropogate(self, path, result):
+        path = np.array(path)
+        self.visits[path] += 1
+        if result > 0:
+            self.whiteWins[path] += result
+        elif result < 0:
+            self.blackWins[path] -= result
+
+    # Move the root to the node for the given board when it is the root, a child or a grandchild of the root
+    # (the AI's move and then the human's reply, counting a draw and its placement as one), otherwise start over
+    # from a new root for it. Everything not under the new root is dropped
+    # Returns how many visits the new root already had
+    def reroot(self, board):
+        key = board.key()
+        level = [ROOT]
+        for depth in range(5):
+            for index in level:
+                if self.key(index) == key:
+                    self.rebuild(index)
+                    return int(self.visits[ROOT])
+            level = [int(child) for index in level for child in self.children(index)]
+        self.clear(board.clone())
+        return 0
+
+    # Pack everything still under the given node into fresh arrays with it as the root, dropping the rest,
+    # and refill the transposition table with what is kept
+    def rebuild(self, root=ROOT):
+        order = [root]
+        newIndex = np.full(self.size, -1, dtype=np.int64)
+        newIndex[root] = 0
+        position = 0
+        while position < len(order):
+            for child in self.children(order[position]):
+                if newIndex[child] == -1:
+                    newIndex[child] = len(order)
+                    order.append(int(child))
+            position += 1
+        old = np.array(order, dtype=np.int64)
+        edgeChild = []
+        edgeAction = []
+        firstEdge = np.zeros(len(order), dtype=np.int64)
+        numEdges = 0
+        for index, oldIndex in enumerate(order):
+            firstEdge[index] = numEdges
+            first = self.firstEdge[oldIndex]
+            count = self.edgeCount[oldIndex]
+            edgeChild.append(newIndex[self.edgeChild[first:first + count]])
+            edgeAction.append(self.edgeAction[first:first + count])
+            reserved = count + len(self.untried[oldIndex])
+            if reserved > count:
+                edgeChild.append(np.zeros(reserved - count, dtype=np.int64))
+                edgeAction.append(np.zeros(reserved - count, dtype=np.int64))
+            numEdges += reserved
+        self.edgeCount = self.edgeCount[old]
+        self.firstEdge = firstEdge
+        self.numEdges = numEdges
+        self.edgeChild = np.concatenate(edgeChild + [np.zeros(1, dtype=np.int64)])
+        self.edgeAction = np.concatenate(edgeAction + [np.zeros(1, dtype=np.int64)])
+        self.visits = self.visits[old]
+        self.whiteWins = self.whiteWins[old]
+        self.blackWins = self.blackWins[old]
+        self.sides = self.sides[old]
+        self.terminal = self.terminal[old]
+        self.drawn = self.drawn[old]
+        self.chance = self.chance[old]
+        self.states = [self.states[index] for index in order]
+        self.untried = [self.untried[index] for index in order]
+        self.actions = [self.actions[index] for index in order]
+        self.size = len(order)
+        if self.table is not None:
+            self.table = TranspositionTable(self.maxTableEntries)
+            for index in range(self.size):
+                self.table.put(self.key(index), index)
+
+    # Cut the least visited subtrees until the tree is down to PRUNETARGET of maxNodes
+    # A cut child's visits stay counted in its parent and its action goes back to the parent's untried actions,
+    # so it can be expanded again later
+    def prune(self):
+        target = int(self.maxNodes * PRUNETARGET)
+        while self.size > target:
+            # Give every node one owner (the first parent reaching it) and count the nodes each one owns
+            owner = np.full(self.size, -1, dtype=np.int64)
+            owner[ROOT] = ROOT
+            order = [ROOT]
+            position = 0
+            while position < len(order):
+                for child in self.children(order[position]):
+                    if owner[child] == -1:
+                        owner[child] = order[position]
+                        order.append(int(child))
+                position += 1
+            sizes = np.ones(self.size, dtype=np.int64)
+            for index in reversed(order[1:]):
+                sizes[owner[index]] += sizes[index]
+            freed = 0
+            for child in sorted(order[1:], key=lambda index: self.visits[index]):
+                if freed >= self.size - target:
+                    break
+                parent = owner[child]
+                first = self.firstEdge[parent]
+                last = first + self.edgeCount[parent] - 1
+                edge = first + int(np.flatnonzero(self.children(parent) == child)[0])
+                self.untried[parent].append(int(self.edgeAction[edge]))
+                self.edgeChild[edge] = self.edgeChild[last]
+                self.edgeAction[edge] = self.edgeAction[last]
+                self.edgeCount[parent] -= 1
+                freed += sizes[child]
+            before = self.size
+            self.rebuild()
+            self.nodes_evicted += before - self.size
+            self.prunes += 1
+            if self.size == before:
+                break
+
+    # Choose action after simulating rollouts the given number of times, for the given number of seconds, or
+    # whichever runs out first when given both. The time is checked between simulations, at least one always runs
+    # How many simulations were completed is left in num_sims_done
+    # When the root can draw from the bag, a quarter of the simulations or time is set aside. If the best action is
+    # drawing, the unit is drawn for real, the node for it becomes the root and the quarter goes to choosing where to
+    # place it, otherwise a serial search carries on with it (a root parallel one leaves it unused)
+    def choose_action(self, num_sims=None, time_budget=None):
+        if num_sims is None and time_budget is None:
+            raise ValueError("choose_action needs a number of simulations, a time budget or both")
+        if self.instrument:
+            self.stats = SearchStats()
+        start = time.perf_counter()
+        sims = num_sims
+        seconds = time_budget
+        reserved = self.can_draw(ROOT) and (num_sims is None or num_sims >= 4)
+        if reserved:
+            if num_sims is not None:
+                sims = num_sims - num_sims // 4
+            if time_budget is not None:
+                seconds = time_budget * 0.75
+        child, done = self.search(sims, seconds)
+        drawing = self.chance[child]
+        if drawing:
+            self.rebuild(self.draw(child)[0])
+            child = self.play_child()
+        if reserved and (drawing or self.workers == 1):
+            sims = None
+            if num_sims is not None:
+                sims = num_sims - done
+            if time_budget is not None:
+                seconds = start + time_budget - time.perf_counter()
+            if (sims is None or sims > 0) and (seconds is None or seconds > 0):
+                child, extra = self.search(sims, seconds)
+                done += extra
+        # Carrying on can end up preferring the draw, which then has to do with what it has already searched
+        if self.chance[child]:
+            self.rebuild(self.draw(child)[0])
+            child = self.play_child()
+        # A unit drawn without anything left to search with still has to go somewhere
+        if self.drawn[ROOT] != EMPTY and child == ROOT and len(self.untried[ROOT]) != 0:
+            child = self.expand(ROOT)
+        self.num_sims_done = done
+        if self.stats is not None:
+            self.stats.sims = done
+            self.stats.treeSize = self.size
+        return self.node(child)
+
+    # Whether drawing from the bag is one of the given node's actions
+    def can_draw(self, index):
+        code = pack_action((DRAW, 0, EMPTY))
+        first = self.firstEdge[index]
+        return code in self.untried[index] or bool((self.edgeAction[first:first + self.edgeCount[index]] == code).any())
+
+    # Search from the root, serially or root parallel, returns the child to play and how many simulations were run
+    def search(self, num_sims, time_budget):
+        if self.workers > 1:
+            child = self.choose_action_parallel(num_sims, time_budget)
+            return child, self.num_sims_done
+        done = self.simulate(num_sims, time_budget)
+        return self.play_child(), done
+
+    # The root's child to play, the root itself if it has none
+    def play_child(self):
+        if self.edgeCount[ROOT] == 0:
+            return ROOT
+        return self.most_visited_child(ROOT)
+
+    # Run selection, rollout and backpropogation steps until num_sims are done or time_budget seconds have passed
+    # Returns how many were run
+    def simulate(self, num_sims=None, time_budget=None):
+        deadline = None
+        if time_budget is not None:
+            deadline = time.perf_counter() + time_budget
+        done = 0
+        while num_sims is None or done < num_sims:
+            if self.batched:
+                count = self.batchSize
+                if num_sims is not None:
+                    count = min(count, num_sims - done)
+                self.simulate_batch(count)
+                done += count
+            elif self.stats is None:
+                path = self.selection_policy()
+                self.backpropogate(path, rollout(self.leaf_board(path[-1]), self.rolloutPlies))
+                done += 1
             else:
-                print("No valid states left somehow")
-                # current_state.print_board()
+                self.simulate_instrumented()
+                done += 1
+            if self.maxNodes is not None and self.size > self.maxNodes:
+                self.prune()
+            if deadline is not None and time.perf_counter() >= deadline:
                 break
-        # current_state.print_board()
-        return checkResults(current_state)
-
-    # Returns the best child to explore next using the UCB1 policy
-    def best_child(self):
-        for c in self.children:
-            weights = [
-                (c.u() / c.n()) + 1.4 * np.sqrt((2 * np.log(self.n()) / c.n()))
-            ]
-        return self.children[np.argmax(weights)]
-
-    # Backpropogate game results up the tree
-    def backpropogate(self, result):
-        self.num_visits += 1
-        self.results[result] += 1
-        if self.parent:
-            self.parent.backpropogate(result)
+        return done
 
-class MCTSTree:
-    def __init__(self, node):
-        self.root = node
-
-    # Choose action after simulating rollouts the given number of times
-    def choose_action(self, num_sims):
-        for x in range(num_sims):
-            n = self.selection_policy()
-            reward = n.rollout()
-            n.backpropogate(reward)
-        return self.root.best_child()
-
-    # Selection policy for tree
+    # One selection, rollout and backpropogation step, timing each phase into stats
+    def simulate_instrumented(self):
+        stats = self.stats
+        expandTime = stats.times["expand"]
+        start = time.perf_counter()
+        path = self.selection_policy()
+        stats.record("selection", time.perf_counter() - start - (stats.times["expand"] - expandTime))
+        stats.maxDepth = max(stats.maxDepth, len(path) - 1)
+        start = time.perf_counter()
+        reward, plies = playout(self.leaf_board(path[-1]), self.rolloutPlies, stats)
+        stats.record("rollout", time.perf_counter() - start)
+        stats.rolloutDepths[plies] += 1
+        start = time.perf_counter()
+        self.backpropogate(path, reward)
+        stats.record("backprop", time.perf_counter() - start)
+
+    # Add (or with sign -1 take back) a virtual loss along the path of node indices, for the side choosing each node
+    def virtual_loss(self, path, sign=1):
+        path = np.array(path)
+        self.visits[path] += sign * VIRTUALLOSS
+        choosers = self.sides[path[:-1]]
+        self.blackWins[path[1:][choosers == 1]] += sign * VIRTUALLOSS
+        self.whiteWins[path[1:][choosers != 1]] += sign * VIRTUALLOSS
+
+    # Select count leaves, score them all together with the evaluator and backpropogate them
+    # With stats, the phases are timed for the whole batch
+    def simulate_batch(self, count):
+        stats = self.stats
+        if stats is not None:
+            expandTime = stats.times["expand"]
+            start = time.perf_counter()
+        paths = []
+        for x in range(count):
+            paths.append(self.selection_policy())
+            self.virtual_loss(paths[-1])
+        for path in paths:
+            self.virtual_loss(path, -1)
+        if stats is not None:
+            stats.record("selection", time.perf_counter() - start - (stats.times["expand"] - expandTime))
+            stats.maxDepth = max([stats.maxDepth] + [len(path) - 1 for path in paths])
+            start = time.perf_counter()
+        leaves = [path[-1] for path in paths]
+        rewards = self.evaluator.evaluate([self.leaf_board(leaf) for leaf in leaves])
+        # Finished games score their result whatever the evaluator makes of them
+        rewards = np.where(self.terminal[leaves] != 0, self.terminal[leaves], rewards)
+        if stats is not None:
+            stats.record("rollout", time.perf_counter() - start)
+            start = time.perf_counter()
+        for path, reward in zip(paths, rewards):
+            self.backpropogate(path, reward)
+        if stats is not None:
+            stats.record("backprop", time.perf_counter() - start)
+
+    # Start searching from the root on a background thread, if not already, until stop_pondering is called
+    # Nothing else may use the tree until then
+    def start_pondering(self):
+        if self.ponderThread is not None:
+            return
+        self.ponderStop.clear()
+        self.ponderSims = 0
+        self.ponderThread = threading.Thread(target=self.ponder, daemon=True)
+        self.ponderThread.start()
+
+    # Runs on the pondering thread, PONDERSIMS simulations at a time so it stops soon after being told to
+    def ponder(self):
+        while not self.ponderStop.is_set():
+            self.ponderSims += self.simulate(PONDERSIMS)
+
+    # Stop pondering and wait for the thread to finish, returns how many simulations it ran
+    def stop_pondering(self):
+        if self.ponderThread is None:
+            return 0
+        self.ponderStop.set()
+        self.ponderThread.join()
+        self.ponderThread = None
+        return self.ponderSims
+
+    # Split the simulations between the workers and merge the statistics of the root's children
+    # With a time budget every worker searches for that long
+    # Returns the index of the root's child for the action with the most visits over all workers, which is given the
+    # merged statistics
+    def choose_action_parallel(self, num_sims=None, time_budget=None):
+        if self.seed is None:
+            seed = random.randrange(2 ** 31)
+        else:
+            seed = self.seed
+        jobs = []
+        for worker in range(self.workers):
+            sims = None
+            if num_sims is not None:
+                sims = num_sims // self.workers
+                if worker < num_sims % self.workers:
+                    sims += 1
+            jobs.append((self.states[ROOT], sims, time_budget, seed + worker, self.rolloutPlies, int(self.drawn[ROOT]),
+                         self.batchSize, self.evaluator if self.batched else None))
+        with multiprocessing.Pool(self.workers) as pool:
+            allStats = pool.map(search_worker, jobs)
+        merged = {}
+        self.num_sims_done = 0
+        for sims, stats in allStats:
+            self.num_sims_done += sims
+            for code, visits, whiteWins, blackWins in stats:
+                total = merged.setdefault(code, [0, 0, 0])
+                total[0] += visits
+                total[1] += whiteWins
+                total[2] += blackWins
+        if len(merged) == 0:
+            return ROOT
+        code = max(merged, key=lambda code: merged[code][0])
+        first = self.firstEdge[ROOT]
+        edges = np.flatnonzero(self.edgeAction[first:first + self.edgeCount[ROOT]] == code)
+        if len(edges) != 0:
+            child = int(self.edgeChild[first + edges[0]])
+        else:
+            if code in self.untried[ROOT]:
+                self.untried[ROOT].remove(code)
+            child = self.add_child(ROOT, code)
+        visits, whiteWins, blackWins = merged[code]
+        self.visits[child] += visits
+        self.whiteWins[child] += whiteWins
+        self.blackWins[child] += blackWins
+        self.visits[ROOT] += sum(total[0] for total in merged.values())
+        return child
+
+    # Selection policy for tree, returns the path of node indices from the root to the node to roll out from
     def selection_policy(self):
-        current_node = self.root
+        current_node = ROOT
+        path = [current_node]
         # While game not over and not all states have been tried, expand, otherwise return best child
-        while checkResults(current_node.state) == 0:
-            if len(current_node.untried_states) != 0:
-                return current_node.expand()
+        while self.terminal[current_node] == 0:
+            if self.chance[current_node]:
+                # Neither side chooses what comes out of the bag, sample it
+                current_node, added = self.draw(current_node)
+                path.append(current_node)
+                if added:
+                    return path
+            elif len(self.untried[current_node]) != 0:
+                current_node = self.expand(current_node)
+                # Drawing goes straight on to what comes out of the bag
+                if not self.chance[current_node] or current_node in path:
+                    path.append(current_node)
+                    return path
+                path.append(current_node)
+            elif self.edgeCount[current_node] == 0:
+                # No legal actions at all, nothing to expand or descend into
+                return path
             else:
-                current_node = current_node.best_child()
-        return current_node
+                current_node = self.best_child(current_node)
+                # A shared node can lead back to a position already on this path, stop there instead of looping
+                if current_node in path:
+                    return path
+                path.append(current_node)
+        return path
+
+# Runs in a worker process for MCTSTree.choose_action_parallel
+# Takes (board, num_sims, time_budget, seed, rolloutPlies, drawn, batchSize, evaluator)
+# Searches from the board with its own tree and returns how many simulations it ran and the statistics of
+# the root's children as a list of (packed action, visits, white wins, black wins)
+def search_worker(job):
+    board, num_sims, time_budget, seed, rolloutPlies, drawn, batchSize, evaluator = job
+    random.seed(seed)
+    np.random.seed(seed)
+    tree = MCTSTree(Node(board, drawn=drawn), batchSize=batchSize, rolloutPlies=rolloutPlies, evaluator=evaluator)
+    sims = tree.simulate(num_sims, time_budget)
+    return sims, tree.child_stats(ROOT)
 
 # Check if a player has won, if not return 0
 def checkResults(state):
-    foundWhiteDuke = False
-    foundBlackDuke = False
-    for row in range(NUM_COLS):
-        for col in range(NUM_COLS):
-            if state.board[row][col].type == WHITEDUKE:
-                foundWhiteDuke = True
-            elif state.board[row][col].type == BLACKDUKE:
-                foundBlackDuke = True
+    foundWhiteDuke = state.whiteDuke != NODUKE
+    foundBlackDuke = state.blackDuke != NODUKE
     if foundBlackDuke and not foundWhiteDuke:
         return -1
     elif foundWhiteDuke and not foundBlackDuke:
@@ -427,43 +1783,875 @@ def checkResults(state):
 
 # Generates all legal actions given the board state
 def gen_legal_actions(board):
-    state = copy.deepcopy(board)
+    state = board.clone()
     valid_states = []
     for row in range(NUM_COLS):
         for col in range(NUM_COLS):
             if state.whiteToPlay == 1:
-                if state.board[row][col].type > 0:
+                if state.typeAt(row, col) > 0:
                     allMoves, allTypes = gen_legal_moves(state, row, col)
                     for index in range(len(allMoves)):
                         resultState = moveUnit(state, allMoves[index], allTypes[index], row, col)
                         valid_states.append(resultState)
             else:
-                if state.board[row][col].type < 0:
+                if state.typeAt(row, col) < 0:
                     allMoves, allTypes = gen_legal_moves(state, row, col)
                     for index in range(len(allMoves)):
                         resultState = moveUnit(state, allMoves[index], allTypes[index], row, col)
                         valid_states.append(resultState)
-        if len(gen_legal_placements(state)) > 0:
-            newUnit = state.bags.pull(state.whiteToPlay)
-            if newUnit != EMPTYTILE:
-                placementOptions = gen_legal_placements(state)
-                for option in placementOptions:
-                    valid_states.append(placeUnit(state, option, newUnit))
+    # One state for every unit that could come out of the bag in every place it could go
+    for unitType in gen_draws(state):
+        for option in gen_legal_placements(state):
+            valid_states.append(placeUnit(state, option, TILES[unitType]))
     return valid_states
 
+# Board after both sides have placed their duke and two footmen at random, the same way the AI sets up in play()
+def gen_random_opening(rng=random):
+    board = Board(NUM_COLS)
+    for side, duke, footman, dukeRow in [(1, WHITEDUKETILE, WHITEFOOTMANTILE, NUM_COLS - 1),
+                                         (-1, BLACKDUKETILE, BLACKFOOTMANTILE, 0)]:
+        board.whiteToPlay = side
+        board = placeStartingUnit(board, (dukeRow, rng.randrange(NUM_COLS)), duke)
+        for x in range(2):
+            options = gen_legal_placements(board)
+            board = placeStartingUnit(board, options[rng.randrange(len(options))], footman)
+    board.whiteToPlay = 1
+    return board
+
+# Time the same fixed seed search serially and root parallel over the given number of workers and print the speedup
+def benchmark_parallel(num_sims=1000, workers=None, seed=0):
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    board = gen_random_opening(random.Random(seed))
+    times = []
+    for numWorkers in [1, workers]:
+        random.seed(seed)
+        np.random.seed(seed)
+        tree = MCTSTree(Node(board), workers=numWorkers, seed=seed)
+        start = time.perf_counter()
+        tree.choose_action(num_sims)
+        times.append(time.perf_counter() - start)
+        print(str(numWorkers) + " worker(s): " + str(round(times[-1], 3)) + "s for " + str(num_sims) + " sims")
+    print("Speedup: " + str(round(times[0] / times[1], 2)) + "x")
+    return times[0] / times[1]
+
+# Fixed positions the benchmarks run on: random openings, and boards a few random plies on from them
+# Seeds random too, gen_legal_action_list draws the unit to place from it
+def reference_positions(seed=0, count=3, midGamePlies=8):
+    rng = random.Random(seed)
+    random.seed(seed)
+    positions = []
+    for x in range(count):
+        opening = gen_random_opening(rng)
+        positions.append(opening)
+        board = opening.clone()
+        for ply in range(midGamePlies):
+            actions = gen_legal_action_list(board)
+            nextBoard = board.clone()
+            make_move(nextBoard, actions[rng.randrange(len(actions))])
+            if checkResults(nextBoard) != 0:
+                break
+            board = nextBoard
+        positions.append(board)
+    return positions
+
+# Count the positions depth plies on from the board with gen_legal_actions, every possible bag draw included
+def perft(board, depth):
+    if depth == 0 or checkResults(board) != 0:
+        return 1
+    return sum(perft(nextBoard, depth - 1) for nextBoard in gen_legal_actions(board))
+
+# Run the benchmark suite on reference_positions and return the results, also writing them as JSON to path if given
+# Every timed benchmark repeats for about duration seconds
+def run_benchmarks(path=None, seed=0, duration=1.0, perftDepth=2):
+    positions = reference_positions(seed)
+    results = {"python": sys.version.split()[0], "seed": seed, "positions": len(positions)}
+
+    # Node counts, these should only change when the rules do
+    counts = []
+    for board in positions:
+        counts.append(perft(board, perftDepth))
+    results["perft_depth"] = perftDepth
+    results["perft"] = counts
+
+    # gen_legal_moves for every unit of the side to play
+    squares = [(board, row, col) for board in positions for row in range(NUM_COLS) for col in range(NUM_COLS)
+               if board.typeAt(row, col) * board.whiteToPlay > 0]
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for board, row, col in squares:
+            gen_legal_moves(board, row, col)
+        calls += len(squares)
+    results["gen_legal_moves_per_sec"] = calls / (time.perf_counter() - start)
+
+    # Random playouts
+    random.seed(seed)
+    np.random.seed(seed)
+    playouts = 0
+    plies = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        plies += playout(positions[playouts % len(positions)])[1]
+        playouts += 1
+    results["rollouts_per_sec"] = playouts / (time.perf_counter() - start)
+    results["mean_rollout_length"] = plies / playouts
+
+    # Whole searches from the first opening
+    results["sims_per_sec"] = {}
+    for num_sims in [100, 500, 1000]:
+        random.seed(seed)
+        np.random.seed(seed)
+        tree = MCTSTree(Node(positions[0]))
+        start = time.perf_counter()
+        tree.choose_action(num_sims)
+        results["sims_per_sec"][str(num_sims)] = tree.num_sims_done / (time.perf_counter() - start)
+
+    # Memory per node, peak over a 1000 simulation search
+    # Run with simulate, choose_action would cut the tree down to the drawn unit's subtree if it picked a draw
+    random.seed(seed)
+    np.random.seed(seed)
+    tracemalloc.start()
+    tree = MCTSTree(Node(positions[0]))
+    tree.simulate(1000)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results["tree_nodes"] = tree.num_nodes
+    results["bytes_per_node"] = peak / tree.num_nodes
+
+    if path is not None:
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+    return results
+
+# Game records
+# A record file is RECORDMAGIC followed by games one after another, each a GAMEHEADER with the board the game started
+# from then one entry per ply, a packed action (which also holds the unit drawn for a placement) on its own or,
+# with RECORDSTATS set in flags, together with the visits and the value from white's side of the searched node
+RECORDMAGIC = b"DUKEGAME"
+RECORDSTATS = 1
+GAMEHEADER = np.dtype([("plies", "<u4"), ("result", "i1"), ("flags", "u1"), ("squares", "i1", (NUM_SQUARES,)),
+                       ("downMask", "<u8"), ("playerBag", "u1"), ("aiBag", "u1"), ("side", "i1")])
+PLYENTRY = np.dtype("<u2")
+PLYSTATSENTRY = np.dtype([("action", "<u2"), ("visits", "<u4"), ("value", "<f4")])
+
+# Appends games to a record file, creating it if needed. Each game goes out as soon as it is written
+class GameRecordWriter:
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(RECORDMAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Write a game that started from the board and went through the actions, ending in result (a checkResults value)
+    # stats is an optional (visits, value) for every action
+    def write_game(self, board, actions, result, stats=None):
+        header = np.zeros(1, dtype=GAMEHEADER)
+        header["plies"] = len(actions)
+        header["result"] = result
+        header["squares"] = np.frombuffer(board.squares, dtype=np.int8)
+        header["downMask"] = board.downMask
+        header["playerBag"] = board.bags.playerBag
+        header["aiBag"] = board.bags.aiBag
+        header["side"] = board.whiteToPlay
+        codes = [pack_action(action) for action in actions]
+        if stats is None:
+            plies = np.array(codes, dtype=PLYENTRY)
+        else:
+            header["flags"] = RECORDSTATS
+            plies = np.array([(code, visits, value) for code, (visits, value) in zip(codes, stats)],
+                             dtype=PLYSTATSENTRY)
+        self.file.write(header.tobytes())
+        self.file.write(plies.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# One game read back from a record file, plies is a view into the file of PLYENTRY or PLYSTATSENTRY
+class GameRecord:
+    def __init__(self, header, plies):
+        self.header = header
+        self.plies = plies
+        self.result = int(header["result"])
+
+    # Board the game started from
+    def start_board(self):
+        return decode_board(self.header["squares"], (self.header["downMask"] >> SQUAREBITS) & np.uint64(1),
+                            (self.header["playerBag"], self.header["aiBag"]), self.header["side"])
+
+    # The packed actions of the game
+    def codes(self):
+        if self.header["flags"] & RECORDSTATS:
+            return self.plies["action"]
+        return self.plies
+
+    def actions(self):
+        return [unpack_action(int(code)) for code in self.codes()]
+
+    # Yields every board of the game from the start on, by replaying the actions with moveUnit and placeUnit
+    def replay(self):
+        board = self.start_board()
+        yield board
+        for fromSq, toSq, moveType in self.actions():
+            if fromSq == PLACE:
+                board = placeUnit(board, divmod(toSq, NUM_COLS), TILES[moveType])
+            else:
+                row, col = divmod(fromSq, NUM_COLS)
+                board = moveUnit(board, divmod(toSq, NUM_COLS), moveType, row, col)
+            yield board
+
+# Reads a record file through a memory map, so only the games looked at are read from disk
+# Iterating goes through the games in order, offsets (built on first use) gives where each one starts
+class GameRecordReader:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            if file.read(len(RECORDMAGIC)) != RECORDMAGIC:
+                raise ValueError(path + " is not a game record file")
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        self.offsets = None
+
+    def __iter__(self):
+        offset = len(RECORDMAGIC)
+        while offset < len(self.data):
+            record, offset = self.read(offset)
+            yield record
+
+    def __len__(self):
+        return len(self.game_offsets())
+
+    def __getitem__(self, index):
+        return self.read(self.game_offsets()[index])[0]
+
+    # Offset of every game in the file, only the headers are read to find them
+    def game_offsets(self):
+        if self.offsets is None:
+            offsets = []
+            offset = len(RECORDMAGIC)
+            while offset < len(self.data):
+                offsets.append(offset)
+                header = self.data[offset:offset + GAMEHEADER.itemsize].view(GAMEHEADER)[0]
+                entry = PLYSTATSENTRY if header["flags"] & RECORDSTATS else PLYENTRY
+                offset += GAMEHEADER.itemsize + int(header["plies"]) * entry.itemsize
+            self.offsets = offsets
+        return self.offsets
+
+    # Game starting at the offset, and the offset of the next one
+    def read(self, offset):
+        header = self.data[offset:offset + GAMEHEADER.itemsize].view(GAMEHEADER)[0]
+        entry = PLYSTATSENTRY if header["flags"] & RECORDSTATS else PLYENTRY
+        start = offset + GAMEHEADER.itemsize
+        end = start + int(header["plies"]) * entry.itemsize
+        return GameRecord(header, self.data[start:end].view(entry)), end
+
+# Games longer than this many plies are stopped and counted as draws in the arena
+MAXGAMEPLIES = 300
+
+# Plays one arena game, takes (agents, seed, whiteAgent) and runs in a worker process when the arena has several
+# Each agent is None for picking uniformly random actions, or a dict of MCTSTree settings plus num_sims and/or
+# time_budget for choose_action. agents[whiteAgent] plays white, both sides get a random opening from the seed
+# Returns the winning agent's index (None for a draw), the number of plies, the seconds each agent spent per move
+# and the game for GameRecordWriter.write_game as (opening, actions, result, stats), stats are 0 for random moves
+def play_arena_game(job):
+    agents, seed, whiteAgent = job
+    random.seed(seed)
+    np.random.seed(seed)
+    rng = random.Random(seed)
+    board = gen_random_opening(rng)
+    opening = board
+    played = []
+    moveStats = []
+    trees = [None, None]
+    moveTimes = [[], []]
+    plies = 0
+    while checkResults(board) == 0 and plies < MAXGAMEPLIES:
+        mover = whiteAgent if board.whiteToPlay == 1 else 1 - whiteAgent
+        agent = agents[mover]
+        start = time.perf_counter()
+        if agent is None:
+            actions = gen_legal_action_list(board)
+            if len(actions) == 0:
+                break
+            action = actions[rng.randrange(len(actions))]
+            board = board.clone()
+            make_move(board, action)
+            played.append(action)
+            moveStats.append((0, 0.0))
+        else:
+            settings = dict(agent)
+            num_sims = settings.pop("num_sims", None)
+            time_budget = settings.pop("time_budget", None)
+            if trees[mover] is None:
+                trees[mover] = MCTSTree(Node(board), **settings)
+            else:
+                trees[mover].reroot(board)
+            best_node = trees[mover].choose_action(num_sims, time_budget)
+            if best_node.action is None:
+                break
+            trees[mover].reroot(best_node.state)
+            board = best_node.state
+            played.append(best_node.action)
+            moveStats.append((best_node.num_visits, (best_node.results[1] - best_node.results[-1]) /
+                              max(best_node.num_visits, 1)))
+        moveTimes[mover].append(time.perf_counter() - start)
+        plies += 1
+    result = checkResults(board)
+    winner = None
+    if result == 1:
+        winner = whiteAgent
+    elif result == -1:
+        winner = 1 - whiteAgent
+    return winner, plies, moveTimes, (opening, played, result, moveStats)
+
+# Play num_games games between two agents (see play_arena_game) without any input, alternating who plays white
+# Games run over a pool of the given number of worker processes, game i is seeded with seed + i
+# Agents searching with more than one worker of their own can only be used with workers=1
+# With recordPath, every game is appended to that game record file
+# Returns and prints the win rate of each agent, the draw rate, game lengths and per move search times
+def run_arena(agents, num_games=20, workers=1, seed=0, recordPath=None):
+    jobs = [(agents, seed + game, game % 2) for game in range(num_games)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            games = pool.map(play_arena_game, jobs)
+    else:
+        games = [play_arena_game(job) for job in jobs]
+    if recordPath is not None:
+        with GameRecordWriter(recordPath) as writer:
+            for game in games:
+                writer.write_game(*game[3])
+    wins = [0, 0]
+    draws = 0
+    allTimes = [[], []]
+    for winner, plies, moveTimes, record in games:
+        if winner is None:
+            draws += 1
+        else:
+            wins[winner] += 1
+        for agent in range(2):
+            allTimes[agent].extend(moveTimes[agent])
+    lengths = [game[1] for game in games]
+    stats = {
+        "games": num_games,
+        "win_rate": [wins[0] / num_games, wins[1] / num_games],
+        "draw_rate": draws / num_games,
+        "mean_length": sum(lengths) / num_games,
+        "min_length": min(lengths),
+        "max_length": max(lengths),
+        "mean_move_time": [sum(times) / max(len(times), 1) for times in allTimes],
+        "max_move_time": [max(times, default=0.0) for times in allTimes],
+    }
+    for agent in range(2):
+        print("Agent " + str(agent) + " (" + str(agents[agent] or "random") + "): won " +
+              str(round(100 * stats["win_rate"][agent], 1)) + "%, " +
+              str(round(1000 * stats["mean_move_time"][agent], 1)) + "ms per move (max " +
+              str(round(1000 * stats["max_move_time"][agent], 1)) + "ms)")
+    print("Draws: " + str(round(100 * stats["draw_rate"], 1)) + "%, game length " + str(stats["min_length"]) +
+          " - " + str(stats["max_length"]) + " plies (mean " + str(round(stats["mean_length"], 1)) + ")")
+    return stats
+
+# Opening book
+# A book file is BOOKMAGIC followed by BOOKENTRY records sorted by Board.key(), one for every position searched
+# holding the packed best action and the statistics of its node
+BOOKMAGIC = b"DUKEBOOK"
+BOOKENTRY = np.dtype([("key", "<u8"), ("action", "<u2"), ("visits", "<u4"),
+                      ("whiteWins", "<f4"), ("blackWins", "<f4")])
+# Where play() looks for a book
+BOOKPATH = "opening_book.bin"
+
+# Every distinct board after both sides have placed their duke and two footmen, white to play
+def gen_setup_positions():
+    positions = [Board(NUM_COLS)]
+    for side, duke, footman, dukeRow in [(1, WHITEDUKETILE, WHITEFOOTMANTILE, NUM_COLS - 1),
+                                         (-1, BLACKDUKETILE, BLACKFOOTMANTILE, 0)]:
+        placed = {}
+        for board in positions:
+            board = board.clone()
+            board.whiteToPlay = side
+            for col in range(NUM_COLS):
+                withDuke = placeStartingUnit(board, (dukeRow, col), duke)
+                for first in gen_legal_placements(withDuke):
+                    withFootman = placeStartingUnit(withDuke, first, footman)
+                    for second in gen_legal_placements(withFootman):
+                        setup = placeStartingUnit(withFootman, second, footman)
+                        placed[setup.key()] = setup
+        positions = list(placed.values())
+    for board in positions:
+        board.whiteToPlay = 1
+    return positions
+
+# Every distinct board up to the given number of plies on from the setup positions
+# Unlike gen_legal_action_list, placements are followed for every unit type still in the bag
+def gen_book_positions(plies=1):
+    level = gen_setup_positions()
+    positions = {board.key(): board for board in level}
+    for ply in range(plies):
+        nextLevel = []
+        for board in level:
+            if checkResults(board) != 0:
+                continue
+            actions = []
+            for action in gen_legal_action_list(board):
+                if action[0] != PLACE:
+                    actions.append(action)
+                else:
+                    bag = board.bags.playerBag if board.whiteToPlay == 1 else board.bags.aiBag
+                    actions.extend((PLACE, action[1], unitType * board.whiteToPlay)
+                                   for unitType in BAGUNITS if bag & (1 << unitType))
+            for action in set(actions):
+                nextBoard = board.clone()
+                make_move(nextBoard, action)
+                if nextBoard.key() not in positions:
+                    positions[nextBoard.key()] = nextBoard
+                    nextLevel.append(nextBoard)
+        level = nextLevel
+    return list(positions.values())
+
+# Runs in a worker process for build_opening_book, takes (board, num_sims, seed)
+# Returns the BOOKENTRY fields for the board
+def book_worker(job):
+    board, num_sims, seed = job
+    random.seed(seed)
+    np.random.seed(seed)
+    best_node = MCTSTree(Node(board)).choose_action(num_sims)
+    return (board.key(), pack_action(best_node.action), best_node.num_visits,
+            best_node.results[1], best_node.results[-1])
+
+# Search every position up to plies on from the setup positions for num_sims simulations and write the best
+# actions to a book file at path. Searches run over a pool of the given number of worker processes
+# Only positions with black to play are searched, play() only asks the book when it is the AI's move
+# limit only searches the first that many positions, for trying the builder out
+# Returns the number of positions in the book
+def build_opening_book(path=BOOKPATH, num_sims=2000, plies=1, workers=1, limit=None, seed=0):
+    positions = [board for board in gen_book_positions(plies)
+                 if board.whiteToPlay == -1 and checkResults(board) == 0]
+    if limit is not None:
+        positions = positions[:limit]
+    jobs = [(board, num_sims, seed + index) for index, board in enumerate(positions)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            records = pool.map(book_worker, jobs)
+    else:
+        records = [book_worker(job) for job in jobs]
+    entries = np.array(records, dtype=BOOKENTRY)
+    entries.sort(order="key")
+    with open(path, "wb") as file:
+        file.write(BOOKMAGIC)
+        file.write(entries.tobytes())
+    return len(entries)
+
+# A book file written by build_opening_book, memory mapped so only the pages that are looked at get read
+class OpeningBook:
+    def __init__(self, path=BOOKPATH):
+        with open(path, "rb") as file:
+            if file.read(len(BOOKMAGIC)) != BOOKMAGIC:
+                raise ValueError(path + " is not an opening book")
+            file.seek(0, 2)
+            size = file.tell() - len(BOOKMAGIC)
+        if size == 0:
+            self.entries = np.zeros(0, dtype=BOOKENTRY)
+        else:
+            self.entries = np.memmap(path, dtype=BOOKENTRY, mode="r", offset=len(BOOKMAGIC))
+        self.keys = self.entries["key"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Book entry for the board, or None if it is not in the book
+    def entry(self, board):
+        index = np.searchsorted(self.keys, np.uint64(board.key()))
+        if index == len(self.keys) or self.keys[index] != board.key():
+            return None
+        return self.entries[index]
+
+    # Best action for the board, or None if it is not in the book or is not legal on it (a book from older rules)
+    # The book only says where to place a unit, placements come back with a unit drawn at random from the bag
+    def lookup(self, board):
+        entry = self.entry(board)
+        if entry is None:
+            return None
+        action = unpack_action(int(entry["action"]))
+        for legal in gen_legal_action_list(board):
+            # Every placement gen_legal_action_list gives is of the one unit it drew
+            if legal == action or (action[0] == PLACE and legal[:2] == action[:2]):
+                return legal
+        return None
+
+# Game server
+# Hosts many games at once over a line protocol, on a local socket or stdin, with the AI's searches run in one
+# process pool shared by everyone. Every line sent gets one reply line, and an "ai" line follows once the AI moves:
+#   new [seconds]                             -> new <game>, start a game as white, the AI thinks that long a move
+#   board <game>                              -> board <game> <side to play> <36 comma separated unit types>
+#   actions <game>                            -> actions <game> <move:row,col,row,col | place:row,col ...>
+#   move <game> <row> <col> <toRow> <toCol>   -> ok <game> <result>, then unless that ended the game
+#                                                ai <game> <from> <to> <type> <result> once the AI has moved
+#   place <game> <row> <col>                  -> the same, pulling a unit from the bag and placing it there
+#   stats                                     -> stats <json of this session's metrics>
+#   quit
+# Results are checkResults values, an AI with no action left sends ai <game> none 0 and the game is a draw
+# Bad lines get error <message>
+# Longest the AI may be given to think per move
+MAXSERVERBUDGET = 10.0
+
+# AI move for a server game, runs in the server's process pool, takes (board, time_budget, seed)
+# Returns the AI's action (None if it has none), the board after it and how many simulations it ran
+def server_search(job):
+    board, time_budget, seed = job
+    random.seed(seed)
+    np.random.seed(seed)
+    tree = MCTSTree(Node(board))
+    best_node = tree.choose_action(time_budget=time_budget)
+    return best_node.action, best_node.state, tree.num_sims_done
+
+# One game on the server, the client plays white
+class ServerGame:
+    def __init__(self, gameId, budget, seed):
+        self.gameId = gameId
+        self.budget = budget
+        self.seed = seed
+        self.board = gen_random_opening(random.Random(seed))
+        self.searching = False
+        self.over = False
+
+# One client of the server: its games and how fast it has been served
+class ServerSession:
+    def __init__(self, sessionId, send):
+        self.sessionId = sessionId
+        self.send = send
+        self.games = {}
+        self.started = time.perf_counter()
+        self.commands = 0
+        self.searches = 0
+        self.sims = 0
+        self.searchTime = 0.0
+        self.waitTime = 0.0
+        self.latencies = []
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        return {
+            "session": self.sessionId,
+            "games": len(self.games),
+            "commands": self.commands,
+            "searches": self.searches,
+            "ai_moves_per_sec": self.searches / (time.perf_counter() - self.started),
+            "mean_latency": sum(latencies) / max(len(latencies), 1),
+            "p95_latency": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+            "max_latency": latencies[-1] if latencies else 0.0,
+            "mean_queue_wait": self.waitTime / max(self.searches, 1),
+            "mean_search_time": self.searchTime / max(self.searches, 1),
+            "sims_per_sec": self.sims / self.searchTime if self.searchTime else 0.0,
+        }
+
+# The server, searches are queued per session and handed to free workers taking the sessions in turn,
+# so a session with many games waiting cannot starve the others
+class GameServer:
+    def __init__(self, workers=None, budget=1.0, seed=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.budget = budget
+        self.rng = random.Random(seed)
+        self.pool = None
+        self.sessions = {}
+        self.nextSession = 0
+        self.nextGame = 0
+        # Session id to its waiting searches, and the sessions with any waiting in the order they get served
+        self.waiting = defaultdict(deque)
+        self.turns = deque()
+        self.freeWorkers = None
+        self.queued = None
+        self.dispatcher = None
+        # The loop only keeps weak references to tasks, these are held until they finish
+        self.tasks = set()
+
+    async def start(self):
+        # Spawned rather than forked, a fork while stdin is being read on another thread hangs the worker
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"))
+        self.freeWorkers = asyncio.Semaphore(self.workers)
+        self.queued = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self.dispatch())
+
+    async def close(self):
+        self.dispatcher.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        # Not waiting for searches still running in the workers, that would hold up the event loop
+        self.pool.shutdown(wait=False)
+
+    # Start the coroutine as a task, holding on to it until it is done so it cannot be collected part way through
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def open_session(self, send):
+        session = ServerSession(self.nextSession, send)
+        self.sessions[session.sessionId] = session
+        self.nextSession += 1
+        return session
+
+    # Queue a search for the session, returns a future for server_search's result and when it started
+    def submit(self, session, job):
+        future = asyncio.get_running_loop().create_future()
+        if len(self.waiting[session.sessionId]) == 0:
+            self.turns.append(session.sessionId)
+        self.waiting[session.sessionId].append((job, future))
+        self.queued.set()
+        return future
+
+    # Hand the waiting searches to the pool as workers come free, one session at a time round robin
+    async def dispatch(self):
+        while True:
+            await self.queued.wait()
+            await self.freeWorkers.acquire()
+            sessionId = self.turns.popleft()
+            job, future = self.waiting[sessionId].popleft()
+            if len(self.waiting[sessionId]) != 0:
+                self.turns.append(sessionId)
+            if len(self.turns) == 0:
+                self.queued.clear()
+            self.spawn(self.run_search(job, future))
+
+    async def run_search(self, job, future):
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.pool, server_search, job)
+            future.set_result((result, start))
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            self.freeWorkers.release()
+
+    # Answer one line from the session, returns False once it has quit
+    def handle(self, session, line):
+        session.commands += 1
+        words = line.split()
+        if len(words) == 0:
+            return True
+        command = words[0]
+        try:
+            if command == "quit":
+                return False
+            elif command == "new":
+                budget = self.budget
+                if len(words) > 1:
+                    budget = float(words[1])
+                    # NaN gets through min and max, and a search with no deadline would keep its worker for good
+                    if not math.isfinite(budget):
+                        raise ValueError(words[1])
+                    budget = min(max(budget, 0.001), MAXSERVERBUDGET)
+                game = ServerGame(self.nextGame, budget, self.rng.randrange(2 ** 31))
+                self.nextGame += 1
+                session.games[game.gameId] = game
+                session.send("new " + str(game.gameId))
+            elif command == "stats":
+                session.send("stats " + json.dumps(session.metrics()))
+            elif command in ("board", "actions", "move", "place"):
+                game = session.games.get(int(words[1]))
+                if game is None:
+                    session.send("error no game " + words[1])
+                elif command == "board":
+                    session.send("board " + str(game.gameId) + " " + str(game.board.whiteToPlay) + " " +
+                                 ",".join(str(unitType) for unitType in game.board.squares))
+                elif command == "actions":
+                    session.send("actions " + str(game.gameId) + " " + " ".join(server_actions(game.board)))
+                elif game.over or game.searching:
+                    session.send("error not your turn in game " + str(game.gameId))
+                else:
+                    self.play_human(session, game, command, [int(word) for word in words[2:]])
+            else:
+                session.send("error unknown command " + command)
+        except (ValueError, IndexError):
+            session.send("error bad command " + line.strip())
+        return True
+
+    # Make the client's move in the game if it is legal and start the AI's reply
+    def play_human(self, session, game, command, args):
+        board = game.board
+        if command == "move":
+            row, col, toRow, toCol = args
+            if board.typeAt(row, col) * board.whiteToPlay <= 0:
+                session.send("error no unit of yours at " + str(row) + " " + str(col))
+                return
+            moveOptions, moveTypes = gen_legal_moves(board, row, col)
+            if (toRow, toCol) not in moveOptions:
+                session.send("error illegal move")
+                return
+            index = moveOptions.index((toRow, toCol))
+            game.board = moveUnit(board, moveOptions[index], moveTypes[index], row, col)
+        else:
+            row, col = args
+            if (row, col) not in gen_legal_placements(board) or len(gen_draws(board)) == 0:
+                session.send("error cannot place at " + str(row) + " " + str(col))
+                return
+            game.board = placeUnit(board, (row, col), board.bags.pull(board.whiteToPlay))
+        session.send("ok " + str(game.gameId) + " " + str(self.check_over(game)))
+        if game.over:
+            return
+        game.searching = True
+        self.spawn(self.play_ai(session, game))
+
+    async def play_ai(self, session, game):
+        asked = time.perf_counter()
+        future = self.submit(session, (game.board, game.budget, self.rng.randrange(2 ** 31)))
+        try:
+            (action, board, sims), started = await future
+        except Exception as error:
+            # The game stays as it was with the client to move again, so it can carry on or start another
+            game.searching = False
+            session.send("error search failed in game " + str(game.gameId) + " " + type(error).__name__)
+            return
+        done = time.perf_counter()
+        session.searches += 1
+        session.sims += sims
+        session.waitTime += started - asked
+        session.searchTime += done - started
+        session.latencies.append(done - asked)
+        game.searching = False
+        if action is None:
+            game.over = True
+            session.send("ai " + str(game.gameId) + " none 0")
+            return
+        game.board = board
+        session.send("ai " + str(game.gameId) + " " + " ".join(str(part) for part in action) + " " +
+                     str(self.check_over(game)))
+
+    # checkResults of the game's board, marking the game over if someone has won
+    def check_over(self, game):
+        result = checkResults(game.board)
+        if result != 0:
+            game.over = True
+        return result
+
+    # Serve one client connected over the socket
+    async def serve_client(self, reader, writer):
+        session = self.open_session(lambda line: writer.write((line + "\n").encode()))
+        while True:
+            line = await reader.readline()
+            if not line or not self.handle(session, line.decode()):
+                break
+            await writer.drain()
+        await writer.drain()
+        writer.close()
+
+    # Serve one client reading lines from stdin and answering on stdout, stdin is read on a thread
+    async def serve_stdin(self):
+        session = self.open_session(lambda line: print(line, flush=True))
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line or not self.handle(session, line):
+                break
+        # Let any AI still thinking finish before going
+        while any(game.searching for game in session.games.values()):
+            await asyncio.sleep(0.05)
+
+# The client's legal actions in the protocol's words, move:row,col,toRow,toCol and place:row,col
+def server_actions(board):
+    actions = []
+    for row in range(NUM_COLS):
+        for col in range(NUM_COLS):
+            if board.typeAt(row, col) * board.whiteToPlay > 0:
+                for toRow, toCol in gen_legal_moves(board, row, col)[0]:
+                    actions.append("move:" + ",".join(str(part) for part in (row, col, toRow, toCol)))
+    if len(gen_draws(board)) != 0:
+        actions.extend("place:" + str(row) + "," + str(col) for row, col in gen_legal_placements(board))
+    return actions
+
+# Run the server on a local socket at the given port, or on stdin and stdout if port is None
+async def run_server(port=None, workers=None, budget=1.0):
+    server = GameServer(workers, budget)
+    await server.start()
+    try:
+        if port is None:
+            await server.serve_stdin()
+        else:
+            listener = await asyncio.start_server(server.serve_client, "127.0.0.1", port)
+            async with listener:
+                await listener.serve_forever()
+    finally:
+        await server.close()
+
+# A client for testing the server, plays games one after another with random moves, each until it ends or has had
+# moves moves. Returns how many AI moves it got and the session's metrics
+async def simulated_client(port, games=2, moves=5, budget=0.05, seed=0):
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    async def ask(line):
+        writer.write((line + "\n").encode())
+        await writer.drain()
+        return (await reader.readline()).decode().split()
+
+    aiMoves = 0
+    for game in range(games):
+        gameId = (await ask("new " + str(budget)))[1]
+        for move in range(moves):
+            actions = (await ask("actions " + gameId))[2:]
+            if len(actions) == 0:
+                break
+            kind, args = rng.choice(actions).split(":")
+            reply = await ask(kind + " " + gameId + " " + args.replace(",", " "))
+            if reply[0] != "ok" or reply[2] != "0":
+                break
+            reply = (await reader.readline()).decode().split()
+            if reply[0] != "ai":
+                break
+            aiMoves += 1
+            if reply[-1] != "0" or reply[2] == "none":
+                break
+    writer.write(b"stats\n")
+    await writer.drain()
+    metrics = json.loads((await reader.readline()).decode().split(" ", 1)[1])
+    writer.write(b"quit\n")
+    await writer.drain()
+    writer.close()
+    return aiMoves, metrics
+
+# Run a server on a free local port with clients simulated clients playing on it at once, and print each one's metrics
+# Returns the metrics
+def run_simulated_clients(clients=4, games=2, moves=5, workers=None, budget=0.05):
+    async def main():
+        server = GameServer(workers, budget)
+        await server.start()
+        listener = await asyncio.start_server(server.serve_client, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.gather(*[simulated_client(port, games, moves, budget, seed)
+                                          for seed in range(clients)])
+        finally:
+            listener.close()
+            await server.close()
+
+    results = asyncio.run(main())
+    for aiMoves, metrics in results:
+        print("Session " + str(metrics["session"]) + ": " + str(aiMoves) + " AI moves, latency mean " +
+              str(round(1000 * metrics["mean_latency"], 1)) + "ms max " + str(round(1000 * metrics["max_latency"], 1)) +
+              "ms, queue wait " + str(round(1000 * metrics["mean_queue_wait"], 1)) + "ms, " +
+              str(round(metrics["sims_per_sec"])) + " sims/s")
+    return [metrics for aiMoves, metrics in results]
+
 # Main game loop, play against AI
 def play():
     # Generate board and bags
     GAMEBOARD = Board(NUM_COLS)
     # Have player enter starting info
+    # Difficulty is how many seconds the AI gets to think each turn
     DIFFICULTY = 0
     selection = int(input("Select which level of difficulty you would like (1 - 3): "))
     if selection == 1:
-        DIFFICULTY = 100
+        DIFFICULTY = 0.5
     elif selection == 2:
-        DIFFICULTY = 500
+        DIFFICULTY = 2
     elif selection == 3:
-        DIFFICULTY = 1000
+        DIFFICULTY = 5
     else:
         print("Invalid difficulty selection try again please")
         play()
@@ -491,9 +2679,16 @@ def play():
     footman2Options = gen_legal_placements(GAMEBOARD)
     GAMEBOARD = placeStartingUnit(GAMEBOARD, footman2Options[random.randrange(len(footman2Options))], BLACKFOOTMANTILE)
     GAMEBOARD.whiteToPlay = 1
-    # Main game loop
+    # Main game loop, answering from the opening book while the position is in it
+    # The AI ponders over the human's replies while they choose a move
     gameOver = False
+    # The tree gets its own copy, pulling from the bag changes GAMEBOARD in place while it is being searched
+    tree = MCTSTree(Node(GAMEBOARD.clone()), maxBytes=PLAYTREEBYTES)
+    book = None
+    if os.path.exists(BOOKPATH):
+        book = OpeningBook(BOOKPATH)
     while not gameOver:
+        tree.start_pondering()
         GAMEBOARD.print_board()
         # Player chooses action
         action = int(input("Choose One:\n Move: 0\n Pull from bag: 1\n"))
@@ -522,6 +2717,7 @@ def play():
             moveIndex = int(input("Select where you would like to place the new unit (0 - " + str(
                 len(placementOptions) - 1) + "): "))
             GAMEBOARD = placeUnit(GAMEBOARD, placementOptions[moveIndex], newUnit)
+        pondered = tree.stop_pondering()
         result = checkResults(GAMEBOARD)
         # Check if game over
         if result > 0:
@@ -536,12 +2732,24 @@ def play():
             print("Game continues, no winner yet\n")
         GAMEBOARD.print_board()
 
-        #AI turn to play
+        #AI turn to play, carrying on with the tree it pondered in when the human's move is in it
         print("AI playing now...")
-        root = Node(GAMEBOARD)
-        tree = MCTSTree(root)
-        best_node = tree.choose_action(DIFFICULTY)
-        GAMEBOARD = best_node.state
+        bookAction = None
+        if book is not None:
+            bookAction = book.lookup(GAMEBOARD)
+        if bookAction is not None:
+            print("AI played from the opening book")
+            GAMEBOARD = GAMEBOARD.clone()
+            make_move(GAMEBOARD, bookAction)
+            tree.reroot(GAMEBOARD)
+        else:
+            reused = tree.reroot(GAMEBOARD)
+            print("AI pondered " + str(pondered) + " simulations while you moved, kept " + str(reused))
+            best_node = tree.choose_action(time_budget=DIFFICULTY)
+            print("AI ran " + str(tree.num_sims_done) + " simulations")
+            tree.reroot(best_node.state)
+            # Copy the board, pulling from the bag changes it in place and the tree still holds this one
+            GAMEBOARD = best_node.state.clone()
         result = checkResults(GAMEBOARD)
         # Check if game over
         if result > 0:
@@ -557,4 +2765,23 @@ def play():
     # Game over, end program
     print("Game ended")
 
-play()
+# Only start a game when run as a script, worker processes import this module too
+# "python main.py arena [games] [workers] [sims]" plays MCTS against a random agent headless instead
+# "python main.py bench [output.json]" runs the benchmark suite
+# "python main.py book [sims] [workers]" builds the opening book at BOOKPATH
+# "python main.py serve [port]" hosts games over the line protocol on a local socket, or on stdin without a port
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        asyncio.run(run_server(int(sys.argv[2]) if len(sys.argv) > 2 else None))
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench":
+        run_benchmarks(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == "book":
+        settings = [int(arg) for arg in sys.argv[2:4]]
+        settings += [2000, multiprocessing.cpu_count()][len(settings):]
+        print(str(build_opening_book(BOOKPATH, settings[0], workers=settings[1])) + " positions written to " + BOOKPATH)
+    elif len(sys.argv) > 1 and sys.argv[1] == "arena":
+        settings = [int(arg) for arg in sys.argv[2:5]]
+        settings += [20, multiprocessing.cpu_count(), 200][len(settings):]
+        run_arena([{"num_sims": settings[2]}, None], num_games=settings[0], workers=settings[1])
+    else:
+        play()
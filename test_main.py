@@ -0,0 +1,154 @@
+import random
+
+import numpy as np
+
+import main
+
+
+# Differential check of gen_legal_moves_bb against gen_legal_moves on the given board
+# Raises an AssertionError naming the square if the two disagree
+def check_moves_bb(board):
+    for side in (1, -1):
+        found = {}
+        for sq, targets, strikes in main.gen_legal_moves_bb(board, side):
+            found[sq] = ({(to, False) for to in main.iter_bits(targets)} |
+                         {(to, True) for to in main.iter_bits(strikes)})
+        for sq in range(main.NUM_SQUARES):
+            if board.squares[sq] * side <= 0:
+                continue
+            legal_moves, moveTypes = main.gen_legal_moves(board, *divmod(sq, main.NUM_COLS))
+            expected = {(main.square(*move), moveType == main.STRIKE) for move, moveType in zip(legal_moves, moveTypes)}
+            assert found.get(sq, set()) == expected, "bitboard moves differ at square " + str(sq)
+
+
+# Bitboard move generation agrees with gen_legal_moves on random boards with random units and facings, and on
+# boards from real openings
+def test_moves_bb():
+    rng = random.Random(0)
+    unitTypes = [unitType for unitType in main.TILES if unitType != main.EMPTY]
+    for x in range(200):
+        board = main.Board(main.NUM_COLS)
+        for sq in range(main.NUM_SQUARES):
+            if rng.random() < 0.4:
+                board.put(sq, rng.choice(unitTypes), rng.random() < 0.5)
+        check_moves_bb(board)
+    for board in main.reference_positions(seed=0):
+        check_moves_bb(board)
+
+
+# Checks batch_legal_actions against gen_legal_action_list on the given boards
+# Raises an AssertionError if any board gets a different set of actions
+def check_batch_legal_actions(boards):
+    squares, down, bags, sides = main.encode_boards(boards)
+    legal, units = main.batch_legal_actions(squares.reshape(len(boards), -1), down.reshape(len(boards), -1), bags,
+                                            sides)
+    moveActions = units.shape[1] * main.NUM_SQUARES
+    for index, board in enumerate(boards):
+        found = set()
+        for choice in np.flatnonzero(legal[index]):
+            if choice >= 2 * moveActions:
+                found.add((main.PLACE, choice - 2 * moveActions))
+            else:
+                moveType = main.MOVE if choice < moveActions else main.STRIKE
+                found.add((int(units[index, (choice // main.NUM_SQUARES) % units.shape[1]]),
+                           choice % main.NUM_SQUARES, moveType))
+        expected = {(fromSq, toSq, moveType) if fromSq != main.PLACE else (main.PLACE, toSq)
+                    for fromSq, toSq, moveType in main.gen_legal_action_list(board)}
+        assert found == expected, "batch actions differ on board " + str(index)
+
+
+# batch_legal_actions finds the same actions as gen_legal_action_list, including boards where units can be placed
+def test_batch_legal_actions():
+    boards = main.reference_positions(seed=1, count=4)
+    boards.append(main.Board(main.NUM_COLS))
+    check_batch_legal_actions(boards)
+
+
+# Seeded random games with every make_move and unmake_move checked against a full recount of the board, then taken
+# back move by move to the opening
+def test_make_unmake_consistency(monkeypatch):
+    monkeypatch.setattr(main, "CHECK_CONSISTENCY", True)
+    for seed in range(5):
+        rng = random.Random(seed)
+        random.seed(seed)
+        board = main.gen_random_opening(rng)
+        history = [board.clone()]
+        undos = []
+        for ply in range(60):
+            actions = main.gen_legal_action_list(board)
+            if len(actions) == 0 or main.checkResults(board) != 0:
+                break
+            undos.append(main.make_move(board, actions[rng.randrange(len(actions))]))
+            history.append(board.clone())
+        while len(undos) != 0:
+            main.unmake_move(board, undos.pop())
+            history.pop()
+            assert board == history[-1]
+
+
+# A tree capped at maxNodes prunes back under it, and every node's edges and untried actions still fit in the block
+# of edges it was given, with no action both expanded and untried
+def test_prune():
+    random.seed(0)
+    np.random.seed(0)
+    tree = main.MCTSTree(main.Node(main.gen_random_opening(random.Random(0))), maxNodes=200)
+    tree.choose_action(2000)
+    assert tree.size <= tree.maxNodes
+    assert tree.nodes_evicted > 0
+    blockEnds = list(tree.firstEdge[1:tree.size]) + [tree.numEdges]
+    for index in range(tree.size):
+        assert tree.firstEdge[index] + tree.edgeCount[index] + len(tree.untried[index]) <= blockEnds[index]
+        edges = tree.edgeAction[tree.firstEdge[index]:tree.firstEdge[index] + tree.edgeCount[index]]
+        actions = [int(code) for code in edges] + list(tree.untried[index])
+        assert len(actions) == len(set(actions))
+        assert (tree.edgeChild[tree.firstEdge[index]:tree.firstEdge[index] + tree.edgeCount[index]] < tree.size).all()
+
+
+# From a seeded opening where the search picks drawing from the bag, choose_action gives a placement of a unit taken
+# from the bag of the side to play, and reroot onto the board it reached keeps the subtree searched under it
+def test_choose_draw():
+    board = main.reference_positions(seed=7, count=1)[0]
+    random.seed(7)
+    np.random.seed(7)
+    tree = main.MCTSTree(main.Node(board))
+    assert tree.can_draw(main.ROOT)
+    best_node = tree.choose_action(200)
+    fromSq, toSq, unitType = best_node.action
+    assert fromSq == main.PLACE and unitType > 0
+    assert board.bags.playerBag & (1 << unitType)
+    assert best_node.state.bags.playerBag == board.bags.playerBag & ~(1 << unitType)
+    assert best_node.state.bags.aiBag == board.bags.aiBag
+    assert best_node.state.squares[toSq] == unitType
+    visits = best_node.num_visits
+    assert visits > 0
+    assert tree.reroot(best_node.state) == visits
+    assert tree.root.state == best_node.state
+    assert tree.size > 1
+
+
+# Seeded arena games written to a record file, with and without stats, replay to exactly the boards make_move gives
+# from the opening, whether read back by iterating or by index
+def test_game_records(tmp_path):
+    path = str(tmp_path / "games.bin")
+    agents = [{"num_sims": 20}, None]
+    games = []
+    with main.GameRecordWriter(path) as writer:
+        for seed in range(2):
+            opening, actions, result, stats = main.play_arena_game((agents, seed, seed % 2))[3]
+            writer.write_game(opening, actions, result, stats if seed == 1 else None)
+            games.append((opening, actions, result, stats))
+    reader = main.GameRecordReader(path)
+    assert len(reader) == len(games)
+    for index, record in enumerate(reader):
+        opening, actions, result, stats = games[index]
+        board = opening.clone()
+        boards = [board.clone()]
+        for action in actions:
+            main.make_move(board, action)
+            boards.append(board.clone())
+        for read in (record, reader[index]):
+            assert read.result == result
+            assert read.actions() == actions
+            assert list(read.replay()) == boards
+        if index == 1:
+            assert list(record.plies["visits"]) == [visits for visits, value in stats]